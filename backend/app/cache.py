@@ -0,0 +1,98 @@
+import asyncio
+import contextlib
+import contextvars
+import hashlib
+import json
+from collections import OrderedDict
+
+from . import metrics
+
+# API calls given up on by the scheduler while computing a result, such a result is incomplete and not cached.
+# Tasks started inside share the same list through the context.
+failed_calls = contextvars.ContextVar("failed_calls", default=None)
+
+
+def record_failure():
+    failures = failed_calls.get()
+    if failures is not None:
+        failures.append(1)
+
+
+@contextlib.contextmanager
+def track_failures():
+    failures = []
+    token = failed_calls.set(failures)
+    try:
+        yield failures
+    finally:
+        try:
+            failed_calls.reset(token)
+        except ValueError:
+            # Async generator closed from another context
+            pass
+
+
+def fingerprint(*values):
+    # Stable hash of json serializable values, ex the (file_path, summary) of every file of a directory
+    return hashlib.sha256(json.dumps(values, sort_keys=True).encode()).hexdigest()
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share a single execution: the first call starts it, the following ones wait
+    for its result or error. The execution is cancelled once every caller gave up (ex, all clients disconnected).
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.calls = {}
+
+    async def run(self, key, func):
+        call = self.calls.get(key)
+        if call is None:
+            call = self.calls[key] = {"task": asyncio.ensure_future(func()), "waiters": 0}
+            call["task"].add_done_callback(lambda _: self.forget(key, call))
+        else:
+            metrics.COALESCED_CALLS.inc(kind=self.kind)
+        call["waiters"] += 1
+        try:
+            return await asyncio.shield(call["task"])
+        finally:
+            call["waiters"] -= 1
+            if call["waiters"] == 0 and not call["task"].done():
+                self.forget(key, call)
+                call["task"].cancel()
+
+    def forget(self, key, call):
+        if self.calls.get(key) is call:
+            del self.calls[key]
+
+
+class ResultCache:
+    """
+    LRU of results by key (ex, the root path and query of a search). An entry is only valid for the fingerprint of the
+    inputs it was computed from, a change of any of them (ex, a summary under the root) makes the next lookup miss
+    and the new result replace it. Results are shared, callers must not modify them.
+    """
+
+    def __init__(self, kind: str, max_size: int):
+        self.kind = kind
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def get(self, key, inputs_fingerprint: str):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != inputs_fingerprint:
+            metrics.RESULT_CACHE.inc(kind=self.kind, result="miss")
+            return None
+        self.entries.move_to_end(key)
+        metrics.RESULT_CACHE.inc(kind=self.kind, result="hit")
+        return entry[1]
+
+    def put(self, key, inputs_fingerprint: str, result):
+        if not self.max_size:
+            return
+        self.entries[key] = (inputs_fingerprint, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
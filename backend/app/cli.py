@@ -0,0 +1,156 @@
+"""
+Offline pre-summarization of many folders, run from the backend folder:
+
+    python -m app.cli /srv/share/docs /srv/share/photos --workers 4
+    python -m app.cli /srv/share/docs --exts ".pdf;.docx" --tree trees.json
+
+Every root is walked once, then the new or modified files of all the roots are split across worker processes which
+share the API limits of the settings. Summaries are stored in the same database as the server, which then answers
+from a warm cache. With --tree, file trees are proposed for each root and written to a JSON file, no file is moved.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from . import metrics
+from .processes import ProcessPool
+
+# Settings divided between the worker processes, a limit of 0 stays unlimited
+SHARED_LIMITS = ("MAX_CONCURRENT_REQUESTS", "TEXT_REQUESTS_PER_MINUTE", "TEXT_TOKENS_PER_MINUTE",
+                 "IMAGE_REQUESTS_PER_MINUTE", "IMAGE_TOKENS_PER_MINUTE", "IMAGE_WORKERS", "EXTRACT_WORKERS")
+
+pool = ProcessPool()
+
+
+def get_llm_requests():
+    return sum(metrics.LLM_REQUESTS.values.values())
+
+
+def get_shared_limits(settings, workers: int):
+    limits = {}
+    for name in SHARED_LIMITS:
+        value = getattr(settings, name)
+        limits[name] = str(max(1, value // workers) if value else 0)
+    return limits
+
+
+def split_shards(changed_files: dict, workers: int):
+    # Biggest files first, each one to the shard with the fewest bytes so far
+    shards = [{} for _ in range(workers)]
+    sizes = [0] * workers
+    file_sizes = {file_path: get_file_size(file_path) for file_path in changed_files}
+    for file_path in sorted(changed_files, key=file_sizes.get, reverse=True):
+        i = sizes.index(min(sizes))
+        shards[i][file_path] = changed_files[file_path]
+        sizes[i] += file_sizes[file_path]
+    return [shard for shard in shards if shard]
+
+
+def get_file_size(file_path):
+    try:
+        return os.path.getsize(file_path)
+    except OSError:
+        return 0
+
+
+async def summarize_files(changed_files: dict):
+    # changed_files: {file_path: (file_hash, summary, summary_version) cached for it or False}
+    from . import run
+
+    llm_requests = get_llm_requests()
+    summarized = 0
+    try:
+        async for _ in run.iter_summaries(run.aiter_documents(list(changed_files)), run.get_summary_workers(),
+                                          changed_files):
+            summarized += 1
+        await asyncio.to_thread(run.db.flush)
+    finally:
+        run.images.pool.shutdown()
+        run.extractors.pool.shutdown()
+    return {"summarized": summarized, "llm_requests": get_llm_requests() - llm_requests}
+
+
+def summarize_shard(changed_files: dict, limits: dict):
+    # Runs in a worker process, the settings are read once the limits of this worker are set
+    os.environ.update(limits)
+    return asyncio.run(summarize_files(changed_files))
+
+
+async def summarize_roots(roots: list, recursive: bool, required_exts: list, workers: int):
+    from . import run
+
+    changed_files = {}
+    for root in roots:
+        unchanged_summaries, root_changed_files, deleted_files = await asyncio.to_thread(
+            run.get_changed_files, root, recursive, required_exts)
+        for file_path in deleted_files:
+            run.index.remove(file_path)
+        changed_files.update(root_changed_files)
+        print(f"{root}: {len(unchanged_summaries)} unchanged, {len(root_changed_files)} new or modified, "
+              f"{len(deleted_files)} deleted files")
+    await asyncio.to_thread(run.db.flush)
+    if not changed_files:
+        return []
+    shards = split_shards(changed_files, workers)
+    if len(shards) == 1:
+        return [await summarize_files(shards[0])]
+    limits = get_shared_limits(run.model.settings, len(shards))
+    try:
+        return await asyncio.gather(*(pool.run(len(shards), summarize_shard, shard, limits) for shard in shards))
+    finally:
+        pool.shutdown()
+
+
+async def main_async(args):
+    from . import run
+
+    roots = [os.path.abspath(root) for root in args.roots]
+    required_exts = args.exts.split(";") if args.exts else run.model.settings.INDEXER_EXTS
+    start = time.perf_counter()
+    results = await summarize_roots(roots, args.recursive, required_exts, args.workers)
+    summarize_seconds = time.perf_counter() - start
+
+    # Every summary is stored by now, files a worker failed on are summarized here
+    trees = []
+    files_count = 0
+    try:
+        for root in roots:
+            summaries = await run.get_dir_summaries(root, args.recursive, required_exts)
+            files_count += len(summaries)
+            if args.tree:
+                trees.append({"root_path": root, "items": await run.create_file_tree(root, summaries)})
+        await asyncio.to_thread(run.db.flush)
+    finally:
+        run.images.pool.shutdown()
+        run.extractors.pool.shutdown()
+    if args.tree:
+        with open(args.tree, "w") as f:
+            json.dump(trees, f, indent=2)
+    seconds = time.perf_counter() - start
+
+    summarized = sum(result["summarized"] for result in results)
+    llm_requests = sum(result["llm_requests"] for result in results)
+    print(f"{len(roots)} roots, {files_count} files in {seconds:.1f}s ({files_count / seconds:.1f} files/s)")
+    if results:
+        print(f"{summarized} files summarized by {len(results)} workers in {summarize_seconds:.1f}s "
+              f"({summarized / summarize_seconds:.1f} files/s), {llm_requests} LLM requests")
+    if args.tree:
+        print(f"file trees written to {args.tree}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize the files of several folders ahead of the server")
+    parser.add_argument("roots", nargs="+", help="folders to summarize")
+    parser.add_argument("--exts", default="", help="extensions separated by ';', defaults to INDEXER_EXTS")
+    parser.add_argument("--no-recursive", dest="recursive", action="store_false", help="skip sub folders")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes sharing the API limits")
+    parser.add_argument("--tree", default="", help="propose a file tree for each root and write them to this JSON "
+                                                   "file, without moving any file")
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
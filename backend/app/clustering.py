@@ -0,0 +1,49 @@
+import re
+import zlib
+
+import numpy as np
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def text_vectors(texts: list, dim: int = 256):
+    # Hashed tf-idf bag of words, used to group summaries when no embedding model is configured
+    counts = np.zeros((len(texts), dim), dtype=np.float32)
+    for i, text in enumerate(texts):
+        for word in re.findall(r"[^\W\d_]{3,}", text.lower()):
+            counts[i, zlib.crc32(word.encode()) % dim] += 1
+    idf = np.log((1 + len(texts)) / (1 + (counts > 0).sum(axis=0))) + 1
+    return normalize(np.log1p(counts) * idf)
+
+
+def kmeans(vectors, k: int, iterations: int = 20, seed: int = 0):
+    # Spherical k-means, returns the group of each vector and the normalized centroids
+    vectors = normalize(np.asarray(vectors, dtype=np.float32))
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), min(k, len(vectors)), replace=False)]
+    labels = None
+    for _ in range(iterations):
+        new_labels = np.argmax(vectors @ centroids.T, axis=1)
+        if labels is not None and np.array_equal(labels, new_labels):
+            break
+        labels = new_labels
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, vectors)
+        # A centroid left without vectors keeps its position
+        centroids = normalize(np.where(np.linalg.norm(sums, axis=1, keepdims=True) > 0, sums, centroids))
+    return labels, centroids
+
+
+def cluster(vectors, k: int):
+    # Returns the groups as lists of vector indices, biggest first, each sorted from the most central vector
+    vectors = normalize(np.asarray(vectors, dtype=np.float32))
+    labels, centroids = kmeans(vectors, k)
+    similarities = np.einsum("ij,ij->i", vectors, centroids[labels])
+    groups = []
+    for label in np.unique(labels):
+        indices = np.flatnonzero(labels == label)
+        groups.append(indices[np.argsort(-similarities[indices])].tolist())
+    return sorted(groups, key=len, reverse=True)
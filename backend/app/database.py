@@ -1,63 +1,425 @@
+import itertools
+import logging
+import os
+import re
 import sqlite3
+import threading
+import time
+
+from . import metrics
+
+logger = logging.getLogger()
+
+# SQLite default limit on host parameters per statement is 999 on older builds
+MAX_QUERY_VARIABLES = 900
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'FileWizardAi.db')
+
+UPSERT_SUMMARY_QUERY = """
+    INSERT INTO files_summary (file_path, file_hash, summary, file_size, file_mtime_ns, file_inode, summary_version,
+        parent_dir)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(file_path) DO UPDATE SET file_hash = excluded.file_hash, summary = excluded.summary,
+        file_size = excluded.file_size, file_mtime_ns = excluded.file_mtime_ns, file_inode = excluded.file_inode,
+        summary_version = excluded.summary_version, embedding = NULL, embedding_model = NULL
+"""
+UPSERT_CACHED_SUMMARY_QUERY = """
+    INSERT INTO summaries_cache (file_hash, summary_version, summary) VALUES (?, ?, ?)
+    ON CONFLICT(file_hash, summary_version) DO UPDATE SET summary = excluded.summary
+"""
+UPDATE_PARENT_DIR_QUERY = "UPDATE files_summary SET parent_dir = ? WHERE file_path = ?"
+UPDATE_STAT_QUERY = "UPDATE files_summary SET file_size = ?, file_mtime_ns = ?, file_inode = ? WHERE file_path = ?"
+
+
+def path_range(path_prefix):
+    # Bounds of the paths starting with path_prefix, usable on the file_path index
+    return path_prefix, path_prefix[:-1] + chr(ord(path_prefix[-1]) + 1)
 
 
 class SQLiteDB:
-    def __init__(self):
-        self.conn = sqlite3.connect('FileWizardAi.db')
-        self.cursor = self.conn.cursor()
-        create_table_query = "CREATE TABLE IF NOT EXISTS files_summary (file_path TEXT PRIMARY KEY,file_hash TEXT NOT NULL,summary TEXT)"
-        self.cursor.execute(create_table_query)
-        self.conn.commit()
+    """
+    Every thread gets its own connection to the WAL mode database, so readers never block the writer.
+    Summary writes go through a write-behind buffer flushed with executemany in a single transaction,
+    once flush_size rows are pending or flush_interval seconds passed, and before any read.
+    """
+
+    def __init__(self, db_path=None, flush_size=500, flush_interval=5):
+        self.db_path = db_path or DEFAULT_DB_PATH
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.local = threading.local()
+        self.lock = threading.RLock()
+        self.pending = []
+        self.last_flush = time.monotonic()
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode = WAL")
+            create_table_query = "CREATE TABLE IF NOT EXISTS files_summary (file_path TEXT PRIMARY KEY,file_hash TEXT NOT NULL,summary TEXT)"
+            self.conn.execute(create_table_query)
+            # Stat signature used to skip re-reading unchanged files
+            self.add_column_if_missing("files_summary", "file_size", "INTEGER")
+            self.add_column_if_missing("files_summary", "file_mtime_ns", "INTEGER")
+            self.add_column_if_missing("files_summary", "file_inode", "INTEGER")
+            # Float32 summary embedding used by the vector search, with the model that produced it
+            self.add_column_if_missing("files_summary", "embedding", "BLOB")
+            self.add_column_if_missing("files_summary", "embedding_model", "TEXT")
+            # Model and prompt that produced the summary, NULL (stale) for summaries stored before it was tracked
+            self.add_column_if_missing("files_summary", "summary_version", "TEXT")
+            # Directory of the file, to list the files of a single directory without scanning the table
+            self.add_column_if_missing("files_summary", "parent_dir", "TEXT")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS files_summary_parent_dir ON files_summary (parent_dir)")
+            rows = self.conn.execute("SELECT file_path FROM files_summary WHERE parent_dir IS NULL").fetchall()
+            self.conn.executemany(UPDATE_PARENT_DIR_QUERY, [(os.path.dirname(path), path) for path, in rows])
+            # Content addressed summaries: a copied or moved file reuses the summary of the same bytes
+            self.conn.execute("CREATE TABLE IF NOT EXISTS summaries_cache (file_hash TEXT NOT NULL, "
+                              "summary_version TEXT NOT NULL, summary TEXT, PRIMARY KEY (file_hash, summary_version))")
+            # Filled by insert_file_summary, triggers of older versions failed the upsert of an already cached content
+            self.conn.execute("DROP TRIGGER IF EXISTS files_summary_cache")
+            self.conn.execute("DROP TRIGGER IF EXISTS files_summary_cache_insert")
+            # Summaries by perceptual hash, shared by the copies of a picture resized or saved in another format
+            self.conn.execute("CREATE TABLE IF NOT EXISTS image_summaries (image_hash TEXT NOT NULL, "
+                              "summary_version TEXT NOT NULL, summary TEXT, PRIMARY KEY (image_hash, summary_version))")
+        self.create_fts_index()
+        self.create_jobs_tables()
+        self.create_moves_tables()
+
+    @property
+    def conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA synchronous = NORMAL")  # Safe with WAL, only the last commits can be lost on power loss
+            conn.execute("PRAGMA temp_store = MEMORY")
+            conn.execute("PRAGMA cache_size = -65536")  # 64MB
+            conn.execute("PRAGMA mmap_size = 268435456")  # 256MB
+            self.local.conn = conn
+        return conn
+
+    def create_fts_index(self):
+        # Full text index over paths and summaries, kept in sync with files_summary by triggers
+        with self.lock:
+            exists = self.conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'files_summary_fts'").fetchone()
+            self.conn.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS files_summary_fts
+                    USING fts5(file_path, summary, content='files_summary', content_rowid='rowid');
+                CREATE TRIGGER IF NOT EXISTS files_summary_ai AFTER INSERT ON files_summary BEGIN
+                    INSERT INTO files_summary_fts(rowid, file_path, summary) VALUES (new.rowid, new.file_path, new.summary);
+                END;
+                CREATE TRIGGER IF NOT EXISTS files_summary_ad AFTER DELETE ON files_summary BEGIN
+                    INSERT INTO files_summary_fts(files_summary_fts, rowid, file_path, summary)
+                        VALUES ('delete', old.rowid, old.file_path, old.summary);
+                END;
+                CREATE TRIGGER IF NOT EXISTS files_summary_au AFTER UPDATE OF file_path, summary ON files_summary BEGIN
+                    INSERT INTO files_summary_fts(files_summary_fts, rowid, file_path, summary)
+                        VALUES ('delete', old.rowid, old.file_path, old.summary);
+                    INSERT INTO files_summary_fts(rowid, file_path, summary) VALUES (new.rowid, new.file_path, new.summary);
+                END;
+            """)
+            if not exists:
+                # Index the summaries stored before the index existed
+                with self.conn:
+                    self.conn.execute("INSERT INTO files_summary_fts(files_summary_fts) VALUES ('rebuild')")
+
+    def create_jobs_tables(self):
+        # Background jobs and their results, kept across restarts so interrupted jobs can be resumed
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, kind TEXT NOT NULL, "
+                              "params TEXT NOT NULL, status TEXT NOT NULL, done INTEGER DEFAULT 0, "
+                              "total INTEGER DEFAULT 0, error TEXT, created_at REAL, updated_at REAL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS job_results (job_id TEXT NOT NULL, seq INTEGER NOT NULL, "
+                              "item TEXT NOT NULL, PRIMARY KEY (job_id, seq))")
+
+    def create_moves_tables(self):
+        # Journal of the reorganizations applied by /update_files, to resume or roll them back
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS move_journals (move_id TEXT PRIMARY KEY, "
+                              "root_path TEXT NOT NULL, status TEXT NOT NULL, created_dirs TEXT NOT NULL, error TEXT, total INTEGER, "
+                              "created_at REAL, updated_at REAL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS move_items (move_id TEXT NOT NULL, seq INTEGER NOT NULL, "
+                              "src_path TEXT NOT NULL, dst_path TEXT NOT NULL, PRIMARY KEY (move_id, seq))")
+
+    def add_column_if_missing(self, table_name, column_name, column_type):
+        columns = [row[1] for row in self.conn.execute(f"PRAGMA table_info({table_name})")]
+        if column_name not in columns:
+            self.conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
+
+    def write(self, sql, params):
+        # Buffered write, executed at the next flush
+        with self.lock:
+            self.pending.append((sql, params))
+            if len(self.pending) >= self.flush_size or time.monotonic() - self.last_flush >= self.flush_interval:
+                self.flush()
+            else:
+                metrics.QUEUE_DEPTH.set(len(self.pending), queue="db_writes")
+
+    def flush(self):
+        with self.lock:
+            # Taken before executing, a failed batch must not stay in the buffer and fail every later flush
+            batch, self.pending = self.pending, []
+            if batch:
+                try:
+                    with metrics.timed("db_write"), self.conn:
+                        # Consecutive statements of the same kind are sent together, keeping the writes order
+                        for sql, group in itertools.groupby(batch, key=lambda item: item[0]):
+                            self.conn.executemany(sql, [params for _, params in group])
+                except sqlite3.Error as e:
+                    logger.error("Error while writing {} rows, retrying them one by one: {}".format(len(batch), e))
+                    self.write_rows(batch)
+                metrics.QUEUE_DEPTH.set(0, queue="db_writes")
+            self.last_flush = time.monotonic()
+
+    def write_rows(self, batch):
+        # Rows failing on their own are dropped, so that one bad row doesn't block the others
+        with metrics.timed("db_write"):
+            for sql, params in batch:
+                try:
+                    with self.conn:
+                        self.conn.execute(sql, params)
+                except sqlite3.Error as e:
+                    logger.error("Error while writing a row, dropped: {}".format(e))
+
+    def query(self, sql, params=(), flush=True):
+        if flush:
+            self.flush()
+        with metrics.timed("db_read"):
+            return self.conn.execute(sql, params).fetchall()
+
+    def query_chunks(self, sql, values, params=()):
+        # Run sql once per chunk of values, sql must contain a "{placeholders}" for the values
+        self.flush()
+        rows = []
+        with metrics.timed("db_read"):
+            for i in range(0, len(values), MAX_QUERY_VARIABLES):
+                chunk = values[i:i + MAX_QUERY_VARIABLES]
+                rows += self.conn.execute(sql.format(placeholders=",".join("?" * len(chunk))),
+                                          (*chunk, *params)).fetchall()
+        return rows
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            self.flush()
+            with metrics.timed("db_write"), self.conn:
+                self.conn.execute(sql, params)
+
+    def executemany(self, sql, params):
+        with self.lock:
+            self.flush()
+            with metrics.timed("db_write"), self.conn:
+                self.conn.executemany(sql, params)
 
     def select(self, table_name, where_clause=None):
         sql = f"SELECT * FROM {table_name}"
         if where_clause:
             sql += f" WHERE {where_clause}"
-        self.cursor.execute(sql)
-        return self.cursor.fetchall()
+        return self.query(sql)
 
     def is_file_exist(self, file_path, file_hash):
-        self.cursor.execute("SELECT * FROM files_summary WHERE file_path = ? AND file_hash = ?", (file_path, file_hash))
-        file = self.cursor.fetchone()
-        return bool(file)
-
-    def insert_file_summary(self, file_path, file_hash, summary):
-        c = self.conn.cursor()
-        c.execute("SELECT * FROM files_summary WHERE file_path=?", (file_path,))
-        user_exists = c.fetchone()
-
-        if user_exists:
-            c.execute("UPDATE files_summary SET file_hash=?, summary=? WHERE file_path=?",
-                      (file_hash, summary, file_path))
-        else:
-            c.execute("INSERT INTO files_summary (file_path, file_hash, summary) VALUES (?, ?, ?)",
-                      (file_path, file_hash, summary))
-        self.conn.commit()
+        return bool(self.query("SELECT 1 FROM files_summary WHERE file_path = ? AND file_hash = ?", (file_path, file_hash)))
+
+    def get_files_hash(self, file_paths):
+        # Returns {file_path: (file_hash, summary, summary_version)} for the already stored files
+        rows = self.query_chunks("SELECT file_path, file_hash, summary, summary_version FROM files_summary "
+                                 "WHERE file_path IN ({placeholders})", file_paths)
+        return {file_path: (file_hash, summary, summary_version) for file_path, file_hash, summary, summary_version in rows}
+
+    def get_cached_summary(self, file_hash, summary_version):
+        # Summaries still in the write buffer are missed, not worth a transaction per lookup
+        result = self.query("SELECT summary FROM summaries_cache WHERE file_hash = ? AND summary_version = ?",
+                            (file_hash, summary_version), flush=False)
+        return result[0][0] if result else None
+
+    def get_image_summary(self, image_hash, summary_version):
+        result = self.query("SELECT summary FROM image_summaries WHERE image_hash = ? AND summary_version = ?",
+                            (image_hash, summary_version), flush=False)
+        return result[0][0] if result else None
+
+    def insert_image_summary(self, image_hash, summary_version, summary):
+        self.write("INSERT OR REPLACE INTO image_summaries (image_hash, summary_version, summary) VALUES (?, ?, ?)",
+                   (image_hash, summary_version, summary))
+
+    def insert_file_summary(self, file_path, file_hash, summary, file_stat=(None, None, None), summary_version=None):
+        # The summary is also kept by content in summaries_cache, for copies of the file
+        with self.lock:
+            self.write(UPSERT_SUMMARY_QUERY, (file_path, file_hash, summary, *file_stat, summary_version,
+                                              os.path.dirname(file_path)))
+            if summary_version is not None and summary:
+                self.write(UPSERT_CACHED_SUMMARY_QUERY, (file_hash, summary_version, summary))
+
+    def insert_file_summaries(self, rows):
+        # rows: list of (file_path, file_hash, summary, file_size, file_mtime_ns, file_inode, summary_version)
+        with self.lock:
+            self.executemany(UPSERT_SUMMARY_QUERY, [(*row, os.path.dirname(row[0])) for row in rows])
+            self.executemany(UPSERT_CACHED_SUMMARY_QUERY, [(row[1], row[6], row[2]) for row in rows
+                                                          if row[6] is not None and row[2]])
+
+    def update_file_stat(self, file_path, file_stat):
+        self.write(UPDATE_STAT_QUERY, (*file_stat, file_path))
+
+    def get_files_stat(self, file_paths):
+        # Returns {file_path: ((size, mtime_ns, inode), file_hash, summary, summary_version)} for the already stored files
+        rows = self.query_chunks("SELECT file_path, file_size, file_mtime_ns, file_inode, file_hash, summary, "
+                                 "summary_version FROM files_summary WHERE file_path IN ({placeholders})", file_paths)
+        return {file_path: ((size, mtime_ns, inode), file_hash, summary, summary_version)
+                for file_path, size, mtime_ns, inode, file_hash, summary, summary_version in rows}
+
+    def update_embeddings(self, embeddings, model_name):
+        # embeddings: list of (file_path, blob)
+        for file_path, blob in embeddings:
+            self.write("UPDATE files_summary SET embedding = ?, embedding_model = ? WHERE file_path = ?",
+                       (blob, model_name, file_path))
+
+    def get_embeddings(self, model_name):
+        return self.query("SELECT file_path, embedding FROM files_summary WHERE embedding_model = ?", (model_name,))
+
+    def get_files_without_embedding(self, file_paths, model_name):
+        return self.query_chunks("SELECT file_path, summary FROM files_summary WHERE file_path IN ({placeholders}) "
+                                 "AND (embedding_model IS NULL OR embedding_model != ?)", file_paths, (model_name,))
+
+    def search_summaries(self, search_query, path_prefix, limit, offset=0):
+        # BM25 ranked (file_path, score) matching any of the query words, matches in the path weigh twice
+        terms = re.findall(r"\w+", search_query)
+        if not terms:
+            return []
+        match = " OR ".join(f'"{term}"' for term in terms)
+        return self.query("SELECT file_path, -bm25(files_summary_fts, 2.0, 1.0) FROM files_summary_fts "
+                          "WHERE files_summary_fts MATCH ? AND substr(file_path, 1, ?) = ? "
+                          "ORDER BY bm25(files_summary_fts, 2.0, 1.0) LIMIT ? OFFSET ?",
+                          (match, len(path_prefix), path_prefix, limit, offset))
 
     def get_file_summary(self, file_path):
-        self.cursor.execute("SELECT summary FROM files_summary WHERE file_path = ?", (file_path,))
-        result = self.cursor.fetchone()
-        return result[0] if result else None
+        result = self.query("SELECT summary FROM files_summary WHERE file_path = ?", (file_path,))
+        return result[0][0] if result else None
 
     def drop_table(self):
-        self.cursor.execute("DROP TABLE IF EXISTS files_summary")
-        self.conn.commit()
+        self.execute("DROP TABLE IF EXISTS files_summary")
 
     def get_all_files(self):
-        self.cursor.execute("SELECT file_path FROM files_summary")
-        results = self.cursor.fetchall()
-        files_path = [row[0] for row in results]
-        return files_path
+        return [row[0] for row in self.query("SELECT file_path FROM files_summary")]
 
-    def update_file(self, old_file_path, new_file_path, new_hash):
-        self.cursor.execute("UPDATE files_summary SET file_path = ?, file_hash = ? WHERE file_path = ?",
-                            (new_file_path, new_hash, old_file_path))
-        self.conn.commit()
+    def move_file(self, old_file_path, new_file_path, file_stat):
+        # Rename a file record, keeping its summary and embedding. Returns False if the file wasn't stored.
+        with self.lock:
+            self.flush()
+            with self.conn:
+                self.conn.execute("DELETE FROM files_summary WHERE file_path = ?", (new_file_path,))
+                cursor = self.conn.execute("UPDATE files_summary SET file_path = ?, parent_dir = ?, file_size = ?, "
+                                           "file_mtime_ns = ?, file_inode = ? WHERE file_path = ?",
+                                           (new_file_path, os.path.dirname(new_file_path), *file_stat, old_file_path))
+            return cursor.rowcount > 0
+
+    def get_summaries_under(self, path_prefix):
+        # Range scan on the primary key, path_prefix must end with a path separator
+        return self.query("SELECT file_path, summary FROM files_summary WHERE file_path >= ? AND file_path < ?",
+                          path_range(path_prefix))
+
+    def get_paths_under(self, path_prefix):
+        return [row[0] for row in self.query("SELECT file_path FROM files_summary WHERE file_path >= ? "
+                                             "AND file_path < ?", path_range(path_prefix))]
+
+    def get_paths_in_dir(self, dir_path):
+        return [row[0] for row in self.query("SELECT file_path FROM files_summary WHERE parent_dir = ?", (dir_path,))]
 
     def delete_records(self, file_paths):
-        placeholders = ",".join("?" * len(file_paths))
-        self.cursor.execute(f"DELETE FROM files_summary WHERE file_path IN ({placeholders})", file_paths)
-        self.conn.commit()
+        # Chunked to stay under the host parameters limit, in a single transaction
+        file_paths = list(file_paths)
+        with self.lock:
+            self.flush()
+            with self.conn:
+                for i in range(0, len(file_paths), MAX_QUERY_VARIABLES):
+                    chunk = file_paths[i:i + MAX_QUERY_VARIABLES]
+                    self.conn.execute(f"DELETE FROM files_summary WHERE file_path IN ({','.join('?' * len(chunk))})",
+                                      chunk)
+
+    def delete_records_under(self, path_prefix):
+        # Delete every file under a directory, returns the deleted paths
+        with self.lock:
+            file_paths = self.get_paths_under(path_prefix)
+            with self.conn:
+                self.conn.execute("DELETE FROM files_summary WHERE file_path >= ? AND file_path < ?",
+                                  path_range(path_prefix))
+            return file_paths
+
+    def create_job(self, job_id, kind, params):
+        now = time.time()
+        self.execute("INSERT INTO jobs (job_id, kind, params, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                     (job_id, kind, params, "queued", now, now))
+
+    def get_job(self, job_id):
+        rows = self.query("SELECT job_id, kind, params, status, done, total, error, created_at, updated_at FROM jobs "
+                          "WHERE job_id = ?", (job_id,))
+        return rows[0] if rows else None
+
+    def get_job_ids(self, statuses):
+        placeholders = ",".join("?" * len(statuses))
+        return [row[0] for row in self.query(f"SELECT job_id FROM jobs WHERE status IN ({placeholders}) "
+                                             "ORDER BY created_at", statuses)]
+
+    def set_job_status(self, job_id, status, error=None):
+        self.execute("UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE job_id = ?",
+                     (status, error, time.time(), job_id))
+
+    def update_job_progress(self, job_id, done, total):
+        self.write("UPDATE jobs SET done = ?, total = ?, updated_at = ? WHERE job_id = ?",
+                   (done, total, time.time(), job_id))
+
+    def add_job_results(self, job_id, start, items):
+        for seq, item in enumerate(items, start):
+            self.write("INSERT OR REPLACE INTO job_results (job_id, seq, item) VALUES (?, ?, ?)", (job_id, seq, item))
+
+    def get_job_results(self, job_id, offset, limit):
+        return [row[0] for row in self.query("SELECT item FROM job_results WHERE job_id = ? AND seq >= ? "
+                                             "ORDER BY seq LIMIT ?", (job_id, offset, limit))]
+
+    def clear_job_results(self, job_id):
+        self.execute("DELETE FROM job_results WHERE job_id = ?", (job_id,))
+
+    def create_move_journal(self, move_id, root_path, moves, created_dirs):
+        now = time.time()
+        with self.lock:
+            self.flush()
+            with self.conn:
+                self.conn.execute("INSERT INTO move_journals (move_id, root_path, status, created_dirs, total, "
+                                  "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  (move_id, root_path, "planned", created_dirs, len(moves), now, now))
+                self.conn.executemany("INSERT INTO move_items (move_id, seq, src_path, dst_path) VALUES (?, ?, ?, ?)",
+                                      [(move_id, seq, src_path, dst_path)
+                                       for seq, (src_path, dst_path) in enumerate(moves)])
+
+    def get_move_journal(self, move_id):
+        rows = self.query("SELECT move_id, root_path, status, created_dirs, error, total, created_at, updated_at "
+                          "FROM move_journals WHERE move_id = ?", (move_id,))
+        return rows[0] if rows else None
+
+    def get_move_ids(self, statuses):
+        placeholders = ",".join("?" * len(statuses))
+        return [row[0] for row in self.query(f"SELECT move_id FROM move_journals WHERE status IN ({placeholders}) "
+                                             "ORDER BY created_at", statuses)]
+
+    def get_move_items(self, move_id):
+        return self.query("SELECT src_path, dst_path FROM move_items WHERE move_id = ? ORDER BY seq", (move_id,))
+
+    def set_move_status(self, move_id, status, error=None):
+        self.execute("UPDATE move_journals SET status = ?, error = ?, updated_at = ? WHERE move_id = ?",
+                     (status, error, time.time(), move_id))
+
+    def move_records(self, moves, move_id, status, error=None):
+        # moves: list of (old_file_path, new_file_path, file_stat). The records keep their summary and embedding,
+        # they are moved with the journal status in a single transaction.
+        with self.lock:
+            self.flush()
+            with metrics.timed("db_write"), self.conn:
+                # A record stored at the destination is replaced, unless there is no record to move there
+                self.conn.executemany("DELETE FROM files_summary WHERE file_path = ? AND EXISTS "
+                                      "(SELECT 1 FROM files_summary WHERE file_path = ?)",
+                                      [(new_file_path, old_file_path) for old_file_path, new_file_path, _ in moves])
+                self.conn.executemany("UPDATE files_summary SET file_path = ?, parent_dir = ?, file_size = ?, "
+                                      "file_mtime_ns = ?, file_inode = ? WHERE file_path = ?",
+                                      [(new_file_path, os.path.dirname(new_file_path), *file_stat, old_file_path)
+                                       for old_file_path, new_file_path, file_stat in moves])
+                self.conn.execute("UPDATE move_journals SET status = ?, error = ?, updated_at = ? WHERE move_id = ?",
+                                  (status, error, time.time(), move_id))
 
     def close(self):
+        self.flush()
         self.conn.close()
+        self.local.conn = None
@@ -0,0 +1,122 @@
+import json
+import os
+import re
+import zipfile
+from xml.etree import ElementTree
+
+from .processes import ProcessPool
+
+# Documents are parsed in worker processes, only as far as the summary needs
+pool = ProcessPool()
+
+# Extractor by file extension: a function (file_path, max_chars) returning the text at the beginning of the file.
+# It must be defined at the top level of a module to be sent to the worker processes.
+# Files without an extractor, or whose extractor fails, are parsed in full by the llama index readers.
+extractors = {}
+
+WORD_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+DRAWING_NS = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+
+
+def register_extractor(*exts):
+    def decorator(func):
+        for ext in exts:
+            extractors[ext.lower()] = func
+        return func
+    return decorator
+
+
+def get_extractor(file_path: str):
+    return extractors.get(os.path.splitext(file_path)[1].lower())
+
+
+def truncate_tokens(text: str, max_tokens: int, encoding_name: str):
+    # Cut text to max_tokens. A token is at least one byte, shorter texts are kept without being tokenized.
+    from .settings import get_encoding
+
+    if len(text.encode("utf-8", errors="ignore")) <= max_tokens:
+        return text
+    encoding = get_encoding(encoding_name)
+    if encoding is None:
+        # Same estimate as count_tokens
+        return text[:max_tokens * 4]
+    tokens = encoding.encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+
+
+def extract_head(file_path: str, max_chars: int, max_tokens: int, encoding_name: str):
+    # Runs in a worker process: the beginning of the file, cut to max_tokens
+    text = get_extractor(file_path)(file_path, max_chars)
+    return truncate_tokens(text or "", max_tokens, encoding_name)
+
+
+def join_head(texts, max_chars: int, separator: str = "\n"):
+    # Join texts until max_chars are collected, without reading the rest
+    head = []
+    size = 0
+    for text in texts:
+        if not text:
+            continue
+        head.append(text)
+        size += len(text) + len(separator)
+        if size >= max_chars:
+            break
+    return separator.join(head)[:max_chars]
+
+
+def iter_xml_paragraphs(file, text_tag: str, paragraph_tag: str):
+    # Streams the paragraphs of an Office XML part, parsed elements are freed as soon as they are read
+    texts = []
+    for _, element in ElementTree.iterparse(file, events=("end",)):
+        if element.tag == text_tag:
+            texts.append(element.text or "")
+        elif element.tag == paragraph_tag:
+            yield "".join(texts)
+            texts = []
+            element.clear()
+
+
+@register_extractor(".txt", ".md", ".csv")
+def extract_text(file_path: str, max_chars: int):
+    with open(file_path, encoding="utf-8", errors="ignore") as f:
+        return f.read(max_chars)
+
+
+@register_extractor(".pdf")
+def extract_pdf(file_path: str, max_chars: int):
+    from pypdf import PdfReader
+
+    # Given a file object pypdf reads the pages it is asked for, not the whole file
+    with open(file_path, "rb") as f:
+        reader = PdfReader(f)
+        return join_head((page.extract_text() for page in reader.pages), max_chars)
+
+
+@register_extractor(".docx")
+def extract_docx(file_path: str, max_chars: int):
+    with zipfile.ZipFile(file_path) as docx, docx.open("word/document.xml") as document:
+        return join_head(iter_xml_paragraphs(document, WORD_NS + "t", WORD_NS + "p"), max_chars)
+
+
+def iter_slides_paragraphs(pptx):
+    slides = [name for name in pptx.namelist() if re.fullmatch(r"ppt/slides/slide\d+\.xml", name)]
+    for name in sorted(slides, key=lambda name: int(re.search(r"\d+", name).group())):
+        with pptx.open(name) as slide:
+            yield from iter_xml_paragraphs(slide, DRAWING_NS + "t", DRAWING_NS + "p")
+
+
+# Old binary .ppt files are not zip files, they go straight to the llama index reader
+@register_extractor(".pptx")
+def extract_pptx(file_path: str, max_chars: int):
+    with zipfile.ZipFile(file_path) as pptx:
+        return join_head(iter_slides_paragraphs(pptx), max_chars)
+
+
+@register_extractor(".ipynb")
+def extract_notebook(file_path: str, max_chars: int):
+    # Markdown and code cells, outputs are left out
+    with open(file_path, encoding="utf-8") as f:
+        notebook = json.load(f)
+    cells = ("".join(cell.get("source", "")) for cell in notebook.get("cells", [])
+             if cell.get("cell_type") in ("markdown", "code"))
+    return join_head(cells, max_chars, "\n\n")
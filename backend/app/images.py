@@ -0,0 +1,59 @@
+import io
+import mimetypes
+
+from .processes import ProcessPool
+
+# Formats the vision models accept as is
+SENT_FORMATS = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp", "GIF": "image/gif"}
+
+# Decoding and resizing big pictures is CPU bound, it runs in worker processes
+pool = ProcessPool()
+
+
+def perceptual_hash(image):
+    # Difference hash: 256 bits telling if each pixel of a 17x16 grayscale thumbnail is brighter than its right
+    # neighbour, followed by the average color (4 levels per channel) and the aspect ratio so that flat images of
+    # different colors or shapes don't collide. Resized or re-encoded copies of a picture usually get the same hash.
+    from PIL import Image
+
+    pixels = list(image.convert("L").resize((17, 16), Image.Resampling.LANCZOS).getdata())
+    bits = 0
+    for row in range(16):
+        for col in range(16):
+            bits = (bits << 1) | (pixels[row * 17 + col] > pixels[row * 17 + col + 1])
+    color = image.convert("RGB").resize((1, 1), Image.Resampling.BOX).getpixel((0, 0))
+    return "{:064x}-{}-{:.2f}".format(bits, "".join(str(value >> 6) for value in color), image.width / image.height)
+
+
+def prepare_image(file_path: str, max_side: int, quality: int):
+    # Returns (data, mime_type, perceptual_hash) with the image downsized so that its longest side is at most max_side.
+    # Runs in a worker process.
+    try:
+        from PIL import Image, ImageOps
+
+        with Image.open(file_path) as image:
+            image_format = image.format
+            full_size = image.size
+            # JPEG images are decoded directly at a reduced scale, without the full resolution bitmap
+            image.draft("RGB", (max_side, max_side))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((max_side, max_side))
+            phash = perceptual_hash(image)
+            if image.size == full_size and image_format in SENT_FORMATS and not getattr(image, "is_animated", False):
+                # Small enough already, sent untouched
+                with open(file_path, "rb") as f:
+                    return f.read(), SENT_FORMATS[image_format], phash
+            output = io.BytesIO()
+            if image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info):
+                image.convert("RGBA").save(output, format="PNG", optimize=True)
+                return output.getvalue(), "image/png", phash
+            image.convert("RGB").save(output, format="JPEG", quality=quality, optimize=True)
+            return output.getvalue(), "image/jpeg", phash
+    except Exception:
+        # Format Pillow can't decode, the file is sent as is
+        with open(file_path, "rb") as f:
+            return f.read(), mimetypes.guess_type(file_path)[0] or "application/octet-stream", None
+
+
+async def load_image(file_path: str, max_side: int, quality: int, workers: int):
+    return await pool.run(workers, prepare_image, file_path, max_side, quality)
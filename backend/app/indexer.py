@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import os
+import time
+
+from . import metrics
+
+logger = logging.getLogger()
+
+try:
+    # inotify on Linux, FSEvents on macOS, ReadDirectoryChangesW on Windows
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+
+class EventHandler(FileSystemEventHandler):
+    # Called from the watchdog thread, events are handed over to the indexer event loop
+    def __init__(self, indexer):
+        self.indexer = indexer
+
+    def on_any_event(self, event):
+        if event.event_type in ("opened", "closed_no_write"):
+            return
+        if event.is_directory:
+            if event.event_type == "moved":
+                self.indexer.add_event(event.src_path, ("deleted_dir",))
+                self.indexer.add_event(event.dest_path, ("dir",))
+            elif event.event_type == "deleted":
+                self.indexer.add_event(event.src_path, ("deleted_dir",))
+            elif event.event_type == "created":
+                self.indexer.add_event(event.src_path, ("dir",))
+        elif event.event_type == "moved":
+            self.indexer.add_event(event.src_path, ("moved", event.dest_path))
+        elif event.event_type == "deleted":
+            self.indexer.add_event(event.src_path, ("deleted",))
+        else:
+            self.indexer.add_event(event.src_path, ("changed",))
+
+
+class Indexer:
+    """
+    Keep the summaries of the configured roots up to date in the background: a first scan at startup, then
+    incremental updates from filesystem events, debounced so that a burst of writes is processed once.
+    Without watchdog, the roots are rescanned every poll_interval seconds instead (only changed stats are re-read),
+    as well as the roots that can't be watched (missing, unmounted or out of inotify watches).
+
+    scan(root, recursive, required_exts) and apply_events(events, required_exts) do the actual indexing.
+    """
+
+    def __init__(self, roots: list, recursive: bool, required_exts: list, scan, apply_events,
+                 debounce: float = 2, poll_interval: float = 60):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.recursive = recursive
+        self.required_exts = {ext.lower() for ext in required_exts}
+        self.scan = scan
+        self.apply_events = apply_events
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.pending = {}
+        self.applying = False
+        self.changed = None
+        self.warm_roots = set()
+        self.observer = None
+        self.task = None
+        self.poll_task = None
+        self.loop = None
+
+    def start(self):
+        if not self.roots:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.changed = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.poll_task is not None:
+            self.poll_task.cancel()
+            self.poll_task = None
+        if self.observer is not None:
+            self.observer.stop()
+            await asyncio.to_thread(self.observer.join)
+            self.observer = None
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def is_warm(self, path: str, recursive: bool, required_exts: list):
+        # Summaries under path can be read from the db as is: watched root, scanned, no event waiting
+        path = os.path.abspath(path)
+        if self.observer is None or self.pending or self.applying or (recursive and not self.recursive):
+            return False
+        if not {ext.lower() for ext in required_exts} <= self.required_exts:
+            return False
+        return any(path == root or path.startswith(os.path.join(root, "")) for root in self.warm_roots)
+
+    def add_event(self, path, event):
+        self.loop.call_soon_threadsafe(self.queue_event, path, event)
+
+    def queue_event(self, path, event):
+        self.pending[path] = event
+        metrics.QUEUE_DEPTH.set(len(self.pending), queue="indexer_events")
+        self.changed.set()
+
+    def start_observer(self):
+        # Returns the observer and the roots it doesn't watch
+        if Observer is None:
+            logger.warning("watchdog is not installed, indexed folders are polled every {}s".format(self.poll_interval))
+            return None, list(self.roots)
+        observer = Observer()
+        handler = EventHandler(self)
+        # Started first so that each watch is set up by schedule, and a root failing doesn't stop the others
+        observer.start()
+        polled_roots = []
+        for root in self.roots:
+            try:
+                observer.schedule(handler, root, recursive=self.recursive)
+            except OSError as e:
+                logger.error("Error while watching {}, it is polled every {}s instead: {}".format(
+                    root, self.poll_interval, e))
+                polled_roots.append(root)
+        return observer, polled_roots
+
+    async def poll(self, roots: list):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            await self.scan_roots(roots)
+
+    async def scan_roots(self, roots: list):
+        for root in roots:
+            try:
+                await self.scan(root, self.recursive, list(self.required_exts))
+            except Exception as e:
+                logger.error("Error while indexing {}: {}".format(root, e))
+
+    async def run(self):
+        # Watch before the first scan so that no change made during the scan is missed
+        self.observer, polled_roots = await asyncio.to_thread(self.start_observer)
+        await self.scan_roots(self.roots)
+        if self.observer is None:
+            await self.poll(self.roots)
+        if polled_roots:
+            self.poll_task = asyncio.create_task(self.poll(polled_roots))
+        self.warm_roots = set(self.roots) - set(polled_roots)
+        logger.info("Indexed folders are up to date, watching for changes")
+        while True:
+            await self.changed.wait()
+            await self.wait_quiet()
+            events, self.pending = self.pending, {}
+            metrics.QUEUE_DEPTH.set(0, queue="indexer_events")
+            self.applying = True
+            try:
+                await self.apply_events(events, list(self.required_exts))
+            except Exception as e:
+                logger.error("Error while indexing changes: {}".format(e))
+            finally:
+                self.applying = False
+
+    async def wait_quiet(self):
+        # Wait for debounce seconds without new events, but no more than 10 debounce periods in total
+        deadline = time.monotonic() + self.debounce * 10
+        while time.monotonic() < deadline:
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), self.debounce)
+            except asyncio.TimeoutError:
+                return
@@ -0,0 +1,129 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+
+from . import metrics
+
+logger = logging.getLogger()
+
+FINISHED_STATUSES = ("done", "failed", "cancelled")
+
+
+class JobManager:
+    """
+    Long directory scans run as background jobs, independently of the HTTP request that submitted them.
+    Jobs, progress and results are stored in the database and a pool of workers processes the queued jobs.
+
+    Every summary is stored as soon as it is ready, so a job interrupted by a restart is queued again at startup
+    and only summarizes the files it hadn't reached: the others are unchanged files read back from the cache.
+
+    handlers maps a job kind to a function taking the job params and returning an async iterator of events,
+    like iter_run: "start" and "summary"/"progress" events update the progress, other events with "items" are results.
+    """
+
+    def __init__(self, db, handlers: dict, workers: int = 2, progress_interval: float = 1):
+        self.db = db
+        self.handlers = handlers
+        self.workers = workers
+        self.progress_interval = progress_interval
+        self.queue = None
+        self.worker_tasks = []
+        self.running = {}
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        # Jobs queued or running when the server stopped are resumed
+        for job_id in await asyncio.to_thread(self.db.get_job_ids, ("queued", "running")):
+            self.queue.put_nowait(job_id)
+        metrics.QUEUE_DEPTH.set(self.queue.qsize(), queue="jobs")
+        self.worker_tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        # Running jobs stay "running" in the database, they are resumed at the next start
+        for task in self.worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+        self.worker_tasks = []
+        await asyncio.to_thread(self.db.flush)
+
+    async def submit(self, kind: str, params: dict):
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job_id = uuid.uuid4().hex
+        await asyncio.to_thread(self.db.create_job, job_id, kind, json.dumps(params))
+        self.queue.put_nowait(job_id)
+        metrics.QUEUE_DEPTH.set(self.queue.qsize(), queue="jobs")
+        return job_id
+
+    async def get(self, job_id: str):
+        row = await asyncio.to_thread(self.db.get_job, job_id)
+        if row is None:
+            return None
+        job_id, kind, params, status, done, total, error, created_at, updated_at = row
+        return {"job_id": job_id, "kind": kind, "params": json.loads(params), "status": status, "done": done,
+                "total": total, "error": error, "created_at": created_at, "updated_at": updated_at}
+
+    async def get_results(self, job_id: str, offset: int = 0, limit: int = 1000):
+        items = await asyncio.to_thread(self.db.get_job_results, job_id, offset, limit)
+        return [json.loads(item) for item in items]
+
+    async def cancel(self, job_id: str):
+        job = await self.get(job_id)
+        if job is None or job["status"] in FINISHED_STATUSES:
+            return job
+        await asyncio.to_thread(self.db.set_job_status, job_id, "cancelled")
+        if job_id in self.running:
+            self.running[job_id].cancel()
+        return await self.get(job_id)
+
+    async def worker(self):
+        while True:
+            job_id = await self.queue.get()
+            metrics.QUEUE_DEPTH.set(self.queue.qsize(), queue="jobs")
+            job = await self.get(job_id)
+            if job is None or job["status"] in FINISHED_STATUSES:
+                continue
+            task = asyncio.create_task(self.run_job(job))
+            self.running[job_id] = task
+            try:
+                # A cancelled job doesn't stop the worker, but a stopped worker stops its job
+                await asyncio.wait([task])
+            finally:
+                self.running.pop(job_id, None)
+                if not task.done():
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+
+    async def run_job(self, job: dict):
+        job_id = job["job_id"]
+        logger.info(f"Starting job {job_id} ({job['kind']})")
+        await asyncio.to_thread(self.db.set_job_status, job_id, "running")
+        # Results of an interrupted run are produced again from the cached summaries
+        await asyncio.to_thread(self.db.clear_job_results, job_id)
+        done, total, results = 0, 0, 0
+        last_progress = time.monotonic()
+        try:
+            async for event in self.handlers[job["kind"]](job["params"]):
+                if event["event"] == "start":
+                    total = event["total"]
+                elif "done" in event:
+                    done = event["done"]
+                elif "items" in event:
+                    items = [json.dumps(item) for item in event["items"]]
+                    await asyncio.to_thread(self.db.add_job_results, job_id, results, items)
+                    results += len(items)
+                if time.monotonic() - last_progress >= self.progress_interval:
+                    last_progress = time.monotonic()
+                    await asyncio.to_thread(self.db.update_job_progress, job_id, done, total)
+            await asyncio.to_thread(self.db.update_job_progress, job_id, done, total)
+            await asyncio.to_thread(self.db.set_job_status, job_id, "done")
+            logger.info(f"Job {job_id} done, {results} results")
+        except asyncio.CancelledError:
+            await asyncio.to_thread(self.db.update_job_progress, job_id, done, total)
+            await asyncio.to_thread(self.db.flush)
+            raise
+        except Exception as e:
+            logger.error("Error in job {}: {}".format(job_id, e))
+            await asyncio.to_thread(self.db.set_job_status, job_id, "failed", str(e))
@@ -0,0 +1,155 @@
+import bisect
+import contextlib
+import contextvars
+import threading
+import time
+
+# Prometheus text format metrics, updated from the event loop and from worker threads
+lock = threading.Lock()
+registry = []
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for name, value in zip(names, values)) + "}"
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def samples(self):
+        # (suffix, label names, label values, value)
+        return [("", self.labels, key, value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, names, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(names, values)} {value}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with lock:
+            counts, total = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        names = self.labels + ("le",)
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bucket, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                samples.append(("_bucket", names, key + (bucket,), cumulative))
+            samples.append(("_sum", self.labels, key, total))
+            samples.append(("_count", self.labels, key, cumulative))
+        return samples
+
+
+def render():
+    with lock:
+        return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+STAGE_SECONDS = Histogram("filewizard_stage_duration_seconds",
+                          "Time spent in each processing stage: walk, parse, hash, image (decoding and downsizing), "
+                          "db_read, db_write, llm, throttle (waiting for rate limits) and backoff (waiting before a "
+                          "retry)",
+                          ("stage",))
+LLM_REQUESTS = Counter("filewizard_llm_requests_total", "LLM API calls by api, key and outcome",
+                       ("api", "key", "outcome"))
+LLM_TOKENS = Counter("filewizard_llm_tokens_total", "Estimated prompt tokens sent by api and key", ("api", "key"))
+LLM_SECONDS = Histogram("filewizard_llm_request_duration_seconds", "Duration of each LLM API call", ("api",))
+SUMMARY_CACHE = Counter("filewizard_summary_cache_total",
+                        "Summary lookups: stat (unchanged file), index (read from the background index), hash (same "
+                        "content at the same path), content (same content elsewhere) or miss (summarized by the LLM)",
+                        ("result",))
+SUMMARY_BATCH_SIZE = Histogram("filewizard_summary_batch_size", "Number of small documents summarized per request",
+                               buckets=(1, 2, 5, 10, 20, 50, 100))
+RESULT_CACHE = Counter("filewizard_result_cache_total",
+                       "File tree and search results: hit (same summaries as a previous call) or miss",
+                       ("kind", "result"))
+COALESCED_CALLS = Counter("filewizard_coalesced_calls_total",
+                          "Calls that joined an identical call in flight instead of running again: summary (same "
+                          "file content), files and search (same request)",
+                          ("kind",))
+QUEUE_DEPTH = Gauge("filewizard_queue_depth", "Items waiting: llm_<api> requests waiting for a slot, pending "
+                    "db_writes, queued jobs, indexer_events waiting to be applied", ("queue",))
+LLM_IN_FLIGHT = Gauge("filewizard_llm_in_flight", "LLM API calls in flight", ("api",))
+HTTP_SECONDS = Histogram("filewizard_http_request_duration_seconds", "Duration of the HTTP requests",
+                         ("method", "path"))
+
+# Breakdown of the current request, summed over the concurrent work done for it
+request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+@contextlib.contextmanager
+def timed(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+def observe_stage(stage: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timings = request_timings.get()
+    if timings is not None:
+        with lock:
+            timings[stage] = timings.get(stage, 0) + seconds
+
+
+@contextlib.contextmanager
+def track_request_timings():
+    # Tasks and threads started inside share the same dict through the context
+    timings = {}
+    token = request_timings.set(timings)
+    start = time.perf_counter()
+    try:
+        yield timings
+    finally:
+        timings["total"] = time.perf_counter() - start
+        for stage in timings:
+            timings[stage] = round(timings[stage], 4)
+        request_timings.reset(token)
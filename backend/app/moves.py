@@ -0,0 +1,167 @@
+import errno
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+FINISHED_STATUSES = ("done", "rolled_back")
+
+
+def resolve(root_path: str, relative_path: str):
+    # Absolute path of a file of the tree, None if it points outside root_path. Paths proposed with a leading
+    # separator (ex, /invoices/2023/a.pdf) are relative to the root too, only ".." can escape it.
+    path = os.path.normpath(os.path.join(root_path, relative_path.lstrip("/\\")))
+    if path == root_path or os.path.commonpath([root_path, path]) != root_path:
+        return None
+    return path
+
+
+def get_missing_dirs(file_paths: list):
+    # Directories to create so that every file path can be written, parents first
+    missing = set()
+    for dir_path in {os.path.dirname(file_path) for file_path in file_paths}:
+        while dir_path not in missing and not os.path.isdir(dir_path):
+            missing.add(dir_path)
+            dir_path = os.path.dirname(dir_path)
+    return sorted(missing, key=lambda dir_path: (dir_path.count(os.sep), dir_path))
+
+
+def copy_file(src_path: str, dst_path: str):
+    # Move across file systems: the copy is renamed into place once complete, then the source is removed
+    part_path = dst_path + ".filewizard-part"
+    shutil.copy2(src_path, part_path)
+    os.replace(part_path, dst_path)
+    os.remove(src_path)
+
+
+class FileMover:
+    """
+    Applies a reorganization of a tree as a whole. The planned moves are written to a journal in the database
+    before any file is touched. Directories are created once, files are renamed (atomic on the same file system)
+    or copied in parallel across file systems, and the database records are moved in a single transaction
+    along with the journal status. Summaries are kept, a moved file doesn't need to be read again.
+
+    The state of each move is read from the file system, so an interrupted or failed reorganization can be
+    resumed or rolled back from its journal: a move whose destination exists and source doesn't is done.
+    """
+
+    def __init__(self, db, index, get_file_stat, copy_workers: int = 4):
+        self.db = db
+        self.index = index
+        self.get_file_stat = get_file_stat
+        self.copy_workers = copy_workers
+        self.lock = threading.Lock()
+
+    def plan(self, root_path: str, items: list):
+        # Returns the (src_path, dst_path) to move and the items skipped with the reason
+        moves, skipped, destinations = [], [], set()
+        for item in items:
+            src_path = resolve(root_path, item["src_path"])
+            dst_path = resolve(root_path, item["dst_path"])
+            if src_path is not None and src_path == dst_path:
+                continue
+            if src_path is None or dst_path is None:
+                reason = "outside of root_path"
+            elif not os.path.isfile(src_path):
+                reason = "source file not found"
+            elif dst_path in destinations or os.path.lexists(dst_path):
+                reason = "destination already exists"
+            else:
+                destinations.add(dst_path)
+                moves.append((src_path, dst_path))
+                continue
+            skipped.append({"src_path": item["src_path"], "dst_path": item["dst_path"], "reason": reason})
+        return moves, skipped
+
+    def move(self, root_path: str, items: list):
+        root_path = os.path.normpath(os.path.abspath(root_path))
+        moves, skipped = self.plan(root_path, items)
+        move_id = uuid.uuid4().hex
+        created_dirs = get_missing_dirs([dst_path for _, dst_path in moves])
+        self.db.create_move_journal(move_id, root_path, moves, json.dumps(created_dirs))
+        result = self.run(move_id, moves, "done")
+        return {**result, "skipped": skipped}
+
+    def resume(self, move_id: str):
+        journal = self.get(move_id)
+        if journal is None or journal["status"] in FINISHED_STATUSES:
+            return journal
+        return self.run(move_id, self.db.get_move_items(move_id), "done")
+
+    def rollback(self, move_id: str):
+        journal = self.get(move_id)
+        if journal is None or journal["status"] == "rolled_back":
+            return journal
+        moves = [(dst_path, src_path) for src_path, dst_path in reversed(self.db.get_move_items(move_id))]
+        result = self.run(move_id, moves, "rolled_back")
+        if result["status"] == "rolled_back":
+            # Directories created by the reorganization are removed if nothing else was put in them
+            for dir_path in reversed(journal["created_dirs"]):
+                try:
+                    os.rmdir(dir_path)
+                except OSError:
+                    pass
+        return result
+
+    def get(self, move_id: str):
+        row = self.db.get_move_journal(move_id)
+        if row is None:
+            return None
+        move_id, root_path, status, created_dirs, error, total, created_at, updated_at = row
+        return {"move_id": move_id, "root_path": root_path, "status": status, "created_dirs": json.loads(created_dirs),
+                "error": error, "total": total, "created_at": created_at, "updated_at": updated_at}
+
+    def run(self, move_id: str, moves: list, done_status: str):
+        with self.lock:
+            self.db.set_move_status(move_id, "running")
+            for dir_path in get_missing_dirs([dst_path for _, dst_path in moves]):
+                try:
+                    os.makedirs(dir_path, exist_ok=True)
+                except OSError as e:
+                    logger.error("Error creating directory {}: {}".format(dir_path, e))
+            moved, copies, errors = [], [], []
+            for src_path, dst_path in moves:
+                src_exists, dst_exists = os.path.lexists(src_path), os.path.lexists(dst_path)
+                if dst_exists and not src_exists:
+                    # Moved before an interruption
+                    moved.append((src_path, dst_path))
+                elif not src_exists or dst_exists:
+                    errors.append(f"{src_path} -> {dst_path}: " + ("destination already exists" if dst_exists
+                                                                 else "source file not found"))
+                else:
+                    try:
+                        os.rename(src_path, dst_path)
+                        moved.append((src_path, dst_path))
+                    except OSError as e:
+                        if e.errno == errno.EXDEV:
+                            copies.append((src_path, dst_path))
+                        else:
+                            errors.append(f"{src_path} -> {dst_path}: {e}")
+            if copies:
+                with ThreadPoolExecutor(self.copy_workers) as executor:
+                    copied = executor.map(lambda move: self.try_copy(*move), copies)
+                    for (src_path, dst_path), error in zip(copies, copied):
+                        if error is None:
+                            moved.append((src_path, dst_path))
+                        else:
+                            errors.append(f"{src_path} -> {dst_path}: {error}")
+            status = "failed" if errors else done_status
+            self.db.move_records([(src_path, dst_path, self.get_file_stat(dst_path)) for src_path, dst_path in moved],
+                                 move_id, status, "\n".join(errors) or None)
+            for src_path, dst_path in moved:
+                self.index.rename(src_path, dst_path)
+            logger.info(f"Moved {len(moved)} files, {len(copies)} copied across file systems, {len(errors)} errors")
+            return {"move_id": move_id, "status": status, "moved": len(moved), "errors": errors}
+
+    @staticmethod
+    def try_copy(src_path: str, dst_path: str):
+        try:
+            copy_file(src_path, dst_path)
+        except OSError as e:
+            return str(e)
+        return None
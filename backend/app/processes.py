@@ -0,0 +1,37 @@
+import asyncio
+import concurrent.futures
+import multiprocessing
+import threading
+
+
+class ProcessPool:
+    """
+    Worker processes for CPU bound work (decoding images, parsing documents), created on first use.
+    """
+
+    def __init__(self):
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get_executor(self, workers: int):
+        with self.lock:
+            if self.executor is None:
+                # spawn rather than fork, the server process has threads holding locks
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            return self.executor
+
+    async def run(self, workers: int, func, *args):
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.get_executor(workers), func, *args)
+        except concurrent.futures.process.BrokenProcessPool:
+            # A worker died (ex, killed for using too much memory), a new pool is created for the next calls
+            self.shutdown()
+            raise
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
@@ -1,16 +1,26 @@
-from llama_index.core.schema import ImageDocument
 import asyncio
-from llama_index.core import Document, SimpleDirectoryReader
-from llama_index.core.node_parser import TokenTextSplitter
 import os
 import logging
 from pathlib import Path
 import hashlib
+import threading
+from typing import TYPE_CHECKING
 
 from .database import SQLiteDB
 from .settings import CustomFormatter
-from .settings import Model
-import shutil
+from .settings import Model, Lazy
+from .scheduler import Batcher, iter_bounded, iterate
+from .cache import SingleFlight, ResultCache, fingerprint, track_failures
+from .indexer import Indexer
+from .jobs import JobManager
+from .moves import FileMover
+from . import extractors
+from . import images
+from . import metrics
+
+if TYPE_CHECKING:
+    from llama_index.core import Document
+    from llama_index.core.schema import ImageDocument
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -18,100 +28,638 @@ ch = logging.StreamHandler()
 ch.setLevel(logging.INFO)
 ch.setFormatter(CustomFormatter())
 logger.addHandler(ch)
-model = Model()
-db = SQLiteDB()
+# Created on first use or at server startup, importing this module has no side effect
+model = Lazy(Model)
+db = Lazy(lambda: SQLiteDB(model.settings.DB_PATH))
+index = Lazy(lambda: create_index())
+index_loaded = False
+# Summaries sent per embeddings request
+EMBEDDING_BATCH_SIZE = 64
+EMBEDDING_BATCH_TOKENS = 32768
+embedding_batcher = Lazy(lambda: Batcher(embed_summaries_batch, EMBEDDING_BATCH_SIZE, EMBEDDING_BATCH_TOKENS))
+# Identical work requested while it is running is done once: summaries of the same content, same requests
+summary_flight = SingleFlight("summary")
+files_flight = SingleFlight("files")
+search_flight = SingleFlight("search")
+# Results of the last requests, kept until a summary under their root changes
+tree_results = Lazy(lambda: ResultCache("tree", model.settings.RESULT_CACHE_SIZE))
+search_results = Lazy(lambda: ResultCache("search", model.settings.RESULT_CACHE_SIZE))
+
+
+# Files summarized as images
+IMAGE_EXTS = {".gif", ".jpg", ".png", ".jpeg", ".webp"}
+# Only the beginning of a document is summarized, extractors read at most DOCUMENT_MAX_CHARS (enough for
+# DOCUMENT_MAX_TOKENS of any text) and the text is then cut to DOCUMENT_MAX_TOKENS, in the extractor worker process
+DOCUMENT_MAX_TOKENS = 6144
+DOCUMENT_MAX_CHARS = DOCUMENT_MAX_TOKENS * 8
+
+
+def get_summary_version(file_path):
+    # Decided by the extension so the stat fast path and the summarization always agree
+    is_image = os.path.splitext(file_path)[1].lower() in IMAGE_EXTS
+    return model.IMAGE_SUMMARY_VERSION if is_image else model.TEXT_SUMMARY_VERSION
+
+
+def is_summary_valid(cached_version, summary_version):
+    # Summaries stored before versions were tracked have no version, they are summarized again once
+    return cached_version == summary_version
+
+
+async def get_summary(file_path, cached, summary_version, summarize):
+    # cached: (file_hash, summary, summary_version) stored for this file path, False if there is none, None to look it up
+    if cached is None:
+        cached = (await asyncio.to_thread(db.get_files_hash, [file_path])).get(file_path)
+    # Disk and sqlite work runs in worker threads, the event loop keeps serving other requests
+    file_stat = await asyncio.to_thread(get_file_stat, file_path)
+    file_hash = await asyncio.to_thread(get_file_hash, file_path)
+    if cached and cached[0] == file_hash and is_summary_valid(cached[2], summary_version):
+        # Only the metadata changed (ex, touched file), keep the summary and refresh the stat signature
+        metrics.SUMMARY_CACHE.inc(result="hash")
+        await asyncio.to_thread(db.update_file_stat, file_path, file_stat)
+        return cached[1]
+    summary = await summary_flight.run((file_hash, summary_version),
+                                       lambda: get_content_summary(file_path, file_hash, summary_version, summarize))
+    await asyncio.to_thread(db.insert_file_summary, file_path, file_hash, summary, file_stat, summary_version)
+    await embed_summary(file_path, summary)
+    return summary
 
 
-async def summarize_document(doc: Document):
+async def get_content_summary(file_path, file_hash, summary_version, summarize):
+    # Copied or moved file, or another path with the same content
+    summary = await asyncio.to_thread(db.get_cached_summary, file_hash, summary_version)
+    if summary is None:
+        return await summarize()
+    metrics.SUMMARY_CACHE.inc(result="content")
+    logger.info(f"Reusing summary of identical content for {file_path}")
+    return summary
+
+
+async def summarize_text(file_path: str, text: str):
+    metrics.SUMMARY_CACHE.inc(result="miss")
+    return await model.summarize_text(text, os.path.basename(file_path))
+
+
+async def summarize_image(image_path: str, summary_version: str):
+    # Only images missing from the cache are decoded, with at most IMAGE_MAX_IN_MEMORY of them held at a time
+    settings = model.settings
+    async with model.image_slots:
+        try:
+            with metrics.timed("image"):
+                data, mime_type, image_hash = await images.load_image(image_path, settings.IMAGE_MAX_SIDE,
+                                                                      settings.IMAGE_QUALITY, settings.IMAGE_WORKERS)
+        except Exception as e:
+            logger.error("Error while preparing image {}: {}".format(image_path, e))
+            return ""
+        if image_hash is not None:
+            summary = await asyncio.to_thread(db.get_image_summary, image_hash, summary_version)
+            if summary:
+                metrics.SUMMARY_CACHE.inc(result="image")
+                logger.info(f"Reusing summary of a similar image for {image_path}")
+                return summary
+        metrics.SUMMARY_CACHE.inc(result="miss")
+        summary = await model.summarize_image_api(data, mime_type, image_path)
+    if image_hash is not None and summary:
+        await asyncio.to_thread(db.insert_image_summary, image_hash, summary_version, summary)
+    return summary
+
+
+async def summarize_document(doc: "Document", cached=None):
     logger.info(f"Processing file {doc.metadata['file_path']}")
-    doc_hash = get_file_hash(doc.metadata['file_path'])
-    if db.is_file_exist(doc.metadata['file_path'], doc_hash):
-        summary = db.get_file_summary(doc.metadata['file_path'])
-    else:
-        summary = await model.summarize_document_api(doc.text)
-        db.insert_file_summary(doc.metadata['file_path'], doc_hash, summary)
+    summary = await get_summary(doc.metadata['file_path'], cached, get_summary_version(doc.metadata['file_path']),
+                                lambda: summarize_text(doc.metadata['file_path'], doc.text))
     return {
         "file_path": doc.metadata['file_path'],
         "summary": summary
     }
 
 
-async def summarize_image_document(doc: ImageDocument):
+async def summarize_image_document(doc: "ImageDocument", cached=None):
     logger.info(f"Processing image {doc.image_path}")
-    image_hash = get_file_hash(doc.image_path)
-    if db.is_file_exist(doc.image_path, image_hash):
-        summary = db.get_file_summary(doc.image_path)
-    else:
-        summary = await model.summarize_image_api(image_path=doc.image_path)
-        db.insert_file_summary(doc.image_path, image_hash, summary)
+    summary_version = get_summary_version(doc.image_path)
+    summary = await get_summary(doc.image_path, cached, summary_version,
+                                lambda: summarize_image(doc.image_path, summary_version))
     return {
         "file_path": doc.image_path,
         "summary": summary
     }
 
 
-async def dispatch_summarize_document(doc):
+async def dispatch_summarize_document(doc, cached=None):
+    from llama_index.core import Document
+    from llama_index.core.schema import ImageDocument
+
     if isinstance(doc, ImageDocument):
-        return await summarize_image_document(doc)
+        return await summarize_image_document(doc, cached)
     elif isinstance(doc, Document):
-        return await summarize_document(doc)
+        return await summarize_document(doc, cached)
     else:
         raise ValueError("Document type not supported")
 
 
+async def iter_summaries(documents, max_workers: int, cached_files: dict = None):
+    # Summarize documents as they are loaded, with at most max_workers of them in memory at a time
+    from llama_index.core.schema import ImageDocument
+
+    cached_files = cached_files or {}
+
+    def summarize(doc):
+        file_path = doc.image_path if isinstance(doc, ImageDocument) else doc.metadata['file_path']
+        return dispatch_summarize_document(doc, cached_files.get(file_path, False))
+    async for summary in iter_bounded((summarize(doc) async for doc in iterate(documents)), max_workers):
+        yield summary
+
+
+def get_summary_workers():
+    # Documents summarized at the same time, enough to fill a batch of small documents for every request slot
+    settings = model.settings
+    return settings.MAX_CONCURRENT_REQUESTS * max(2, settings.SUMMARY_BATCH_MAX_FILES)
+
+
 async def get_summaries(documents):
-    docs_summaries = await asyncio.gather(
-        *[dispatch_summarize_document(doc) for doc in documents]
-    )
-    return docs_summaries
+    return [summary async for summary in iter_summaries(documents, get_summary_workers())]
+
+
+def create_index():
+    # numpy is only imported once the index is used
+    from .vector_index import VectorIndex
+    return VectorIndex()
+
+
+async def load_index():
+    from .vector_index import from_blob
+
+    global index_loaded
+    if not index_loaded:
+        for file_path, blob in await asyncio.to_thread(db.get_embeddings, model.EMBEDDING_MODEL_NAME):
+            index.add(file_path, from_blob(blob))
+        index_loaded = True
+
+
+async def embed_missing(file_paths: set):
+    # Summaries are embedded as they are stored, only the ones stored before or whose embedding failed are left
+    await load_index()
+    missing = index.get_missing(file_paths)
+    if missing:
+        await embed_summaries(await asyncio.to_thread(db.get_files_without_embedding, list(missing),
+                                                      model.EMBEDDING_MODEL_NAME))
+
+
+async def embed_summary(file_path: str, summary: str):
+    # New summaries are embedded together with the ones made at the same time, a request per batch
+    if not model.EMBEDDING_MODEL_NAME:
+        return
+    await embedding_batcher.submit((file_path, summary), model.count_tokens([summary or ""]))
+
+
+async def embed_summaries_batch(files: list):
+    await embed_summaries(files)
+    return [None] * len(files)
 
 
-async def remove_deleted_files():
-    file_paths = db.get_all_files()
-    deleted_file_paths = [file_path for file_path in file_paths if not os.path.exists(file_path)]
-    db.delete_records(deleted_file_paths)
+async def embed_summaries(files: list, batch_size: int = EMBEDDING_BATCH_SIZE):
+    # files: list of (file_path, summary), embeddings are stored in the db and added to the in memory index
+    if not model.EMBEDDING_MODEL_NAME:
+        return
+    from .vector_index import to_blob
 
+    for i in range(0, len(files), batch_size):
+        batch = files[i:i + batch_size]
+        try:
+            vectors = await model.embed_api([summary or "" for _, summary in batch])
+        except Exception as e:
+            logger.error(f"Error while embedding summaries: {e}")
+            continue
+        await asyncio.to_thread(db.update_embeddings,
+                                [(file_path, to_blob(vector)) for (file_path, _), vector in zip(batch, vectors)],
+                                model.EMBEDDING_MODEL_NAME)
+        if index_loaded:
+            for (file_path, _), vector in zip(batch, vectors):
+                index.add(file_path, vector)
+
+
+def list_files(path: str, recursive: bool, required_exts: list):
+    # Same selection rules as SimpleDirectoryReader: hidden files are skipped, extensions are case-insensitive
+    required_exts = {ext.lower() for ext in required_exts}
+    files = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if recursive:
+                    files.update(list_files(entry.path, recursive, required_exts))
+            elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in required_exts:
+                stat = entry.stat()
+                files[entry.path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+    return files
+
+
+def is_listed(file_path: str, path_prefix: str, required_exts: set):
+    # Whether list_files would return this file if it still existed
+    parts = file_path[len(path_prefix):].split(os.sep)
+    return not any(part.startswith(".") for part in parts) and os.path.splitext(file_path)[1].lower() in required_exts
+
+
+def delete_removed_files(path: str, recursive: bool, required_exts: list, files: dict):
+    # Diff the files stored under path against the directory walk, only this root is looked at.
+    # Stored files the walk skips on purpose (other extensions, hidden folders) are checked on disk.
+    path_prefix = os.path.join(path, "")
+    stored_files = db.get_paths_under(path_prefix) if recursive else db.get_paths_in_dir(os.path.dirname(path_prefix))
+    required_exts = {ext.lower() for ext in required_exts}
+    deleted_files = [file_path for file_path in stored_files if file_path not in files
+                     and (is_listed(file_path, path_prefix, required_exts) or not os.path.exists(file_path))]
+    db.delete_records(deleted_files)
+    return deleted_files
+
+
+def split_changed_files(files: dict):
+    # Split files into unchanged ones (same size/mtime/inode as cached, summary is reused as is)
+    # and new or modified ones that must be read again, with their cached (file_hash, summary, summary_version) if any
+    cached_files = db.get_files_stat(list(files))
+    unchanged_summaries = []
+    changed_files = {}
+    for file_path, file_stat in files.items():
+        cached = cached_files.get(file_path)
+        if cached and cached[0] == file_stat and is_summary_valid(cached[3], get_summary_version(file_path)):
+            unchanged_summaries.append({"file_path": file_path, "summary": cached[2]})
+        else:
+            changed_files[file_path] = cached[1:] if cached else False
+    metrics.SUMMARY_CACHE.inc(len(unchanged_summaries), result="stat")
+    return unchanged_summaries, changed_files
+
+
+def get_changed_files(path: str, recursive: bool, required_exts: list):
+    # A single walk of the directory gives the unchanged, the new or modified and the deleted files
+    with metrics.timed("walk"):
+        files = list_files(path, recursive, required_exts)
+    unchanged_summaries, changed_files = split_changed_files(files)
+    deleted_files = delete_removed_files(path, recursive, required_exts, files)
+    return unchanged_summaries, changed_files, deleted_files
+
+
+# Reader instance per file extension, created the first time a file of this type is read and then reused:
+# some of them are costly to create (the audio and video reader loads a whisper model)
+file_readers = {}
+file_readers_lock = threading.Lock()
+
+
+def get_file_readers(input_files: list):
+    from llama_index.core import SimpleDirectoryReader
+
+    default_readers = SimpleDirectoryReader.supported_suffix_fn()
+    with file_readers_lock:
+        for ext in {os.path.splitext(file_path)[1].lower() for file_path in input_files}:
+            if ext in default_readers and ext not in file_readers:
+                file_readers[ext] = default_readers[ext]()
+    return file_readers
+
+
+def split_input_files(input_files: list):
+    # (images, files with a head extractor, files parsed by the llama index readers)
+    image_files, extracted_files, read_files = [], [], []
+    for file_path in input_files:
+        if os.path.splitext(file_path)[1].lower() in IMAGE_EXTS:
+            image_files.append(file_path)
+        elif extractors.get_extractor(file_path) is not None:
+            extracted_files.append(file_path)
+        else:
+            read_files.append(file_path)
+    return image_files, extracted_files, read_files
+
+
+def iter_image_documents(image_files: list):
+    from llama_index.core.schema import ImageDocument
+
+    # Images are not decoded here, only the ones that need a summary are prepared by summarize_image
+    for file_path in image_files:
+        try:
+            yield ImageDocument(image_path=file_path, metadata={"file_path": file_path})
+        except ValueError as e:
+            logger.error(f"Error reading image {file_path}: {e}")
+
+
+def make_document(file_path: str, text: str):
+    # text is already cut to DOCUMENT_MAX_TOKENS by extractors.extract_head
+    from llama_index.core import Document
+
+    return Document(text=text, metadata={"file_path": file_path})
+
+
+def extract_head(file_path: str):
+    return extractors.extract_head(file_path, DOCUMENT_MAX_CHARS, DOCUMENT_MAX_TOKENS,
+                                   model.settings.TOKENIZER_ENCODING)
+
+
+def iter_read_documents(input_files: list):
+    if not input_files:
+        return
+    # llama index and the readers it needs are only imported once there is a file to read
+    from llama_index.core import Document, SimpleDirectoryReader
+    from llama_index.core.node_parser import TokenTextSplitter
 
-def load_documents(path: str, recursive: bool, required_exts: list):
     reader = SimpleDirectoryReader(
-        input_dir=path,
-        recursive=recursive,
-        required_exts=required_exts,
+        input_files=input_files,
+        file_extractor=get_file_readers(input_files),
         errors='ignore'
     )
-    splitter = TokenTextSplitter(chunk_size=6144)
-    documents = []
+    splitter = TokenTextSplitter(chunk_size=DOCUMENT_MAX_TOKENS)
     for docs in reader.iter_data():
         # By default, llama index split files into multiple "documents"
         if len(docs) > 1:
             try:
                 # So we first join all the document contexts, then truncate by token count
                 text = splitter.split_text("\n".join([d.text for d in docs]))[0]
-                documents.append(Document(text=text, metadata=docs[0].metadata))
+                yield Document(text=text, metadata=docs[0].metadata)
             except Exception as e:
                 logger.error(f"Error reading file {docs[0].metadata['file_path']} \n")  # , e.args)
         else:
-            documents.append(docs[0])
-    return documents
+            yield docs[0]
+
+
+def iter_documents(input_files: list):
+    # Same documents as aiter_documents, parsed one at a time in the calling thread
+    image_files, extracted_files, read_files = split_input_files(input_files)
+    yield from iter_image_documents(image_files)
+    for file_path in extracted_files:
+        try:
+            yield make_document(file_path, extract_head(file_path))
+        except Exception as e:
+            logger.error("Error extracting {}, parsing the whole file: {}".format(file_path, e))
+            read_files.append(file_path)
+    yield from iter_read_documents(read_files)
+
+
+def load_documents(input_files: list):
+    return list(iter_documents(input_files))
+
+
+def next_document(documents, end):
+    with metrics.timed("parse"):
+        return next(documents, end)
+
+
+async def aiter_thread(documents):
+    # Steps a synchronous iterator of documents in a worker thread
+    end = object()
+    while (doc := await asyncio.to_thread(next_document, documents, end)) is not end:
+        yield doc
+
+
+async def aiter_documents(input_files: list):
+    # Documents are yielded as soon as they are ready: images first, then the files with a head extractor,
+    # parsed concurrently in worker processes, then the other files, parsed by the llama index readers in a thread
+    image_files, extracted_files, read_files = split_input_files(input_files)
+    async for doc in aiter_thread(iter_image_documents(image_files)):
+        yield doc
+
+    async def extract(file_path):
+        try:
+            with metrics.timed("parse"):
+                text = await extractors.pool.run(model.settings.EXTRACT_WORKERS, extractors.extract_head, file_path,
+                                                 DOCUMENT_MAX_CHARS, DOCUMENT_MAX_TOKENS,
+                                                 model.settings.TOKENIZER_ENCODING)
+            return make_document(file_path, text)
+        except Exception as e:
+            logger.error("Error extracting {}, parsing the whole file: {}".format(file_path, e))
+            read_files.append(file_path)
+            return None
+
+    async for doc in iter_bounded((extract(file_path) for file_path in extracted_files),
+                                  model.settings.EXTRACT_WORKERS * 2):
+        if doc is not None:
+            yield doc
+    async for doc in aiter_thread(iter_read_documents(read_files)):
+        yield doc
+
+
+def get_indexed_summaries(path: str, recursive: bool, required_exts: list):
+    # Summaries kept up to date by the background indexer, no need to walk the directory
+    path = os.path.join(os.path.abspath(path), "")
+    required_exts = {ext.lower() for ext in required_exts}
+    return [{"file_path": file_path, "summary": summary}
+            for file_path, summary in db.get_summaries_under(path)
+            if is_listed(file_path, path, required_exts) and (recursive or os.path.dirname(file_path) == path[:-1])]
+
+
+async def iter_dir_summaries(path: str, recursive: bool, required_exts: list):
+    # Yields a "start" event with the number of files, then a "summary" event per file as soon as it is ready
+    if indexer.is_warm(path, recursive, required_exts):
+        unchanged_summaries = await asyncio.to_thread(get_indexed_summaries, path, recursive, required_exts)
+        changed_files = {}
+        metrics.SUMMARY_CACHE.inc(len(unchanged_summaries), result="index")
+        logger.info(f"{len(unchanged_summaries)} files read from the index")
+    else:
+        unchanged_summaries, changed_files, deleted_files = await asyncio.to_thread(get_changed_files, path, recursive,
+                                                                                    required_exts)
+        logger.info(f"{len(unchanged_summaries)} unchanged files, {len(changed_files)} new or modified files, "
+                    f"{len(deleted_files)} deleted files")
+        for file_path in deleted_files:
+            index.remove(file_path)
+    total = len(unchanged_summaries) + len(changed_files)
+    yield {"event": "start", "total": total}
+
+    async def all_summaries():
+        for summary in unchanged_summaries:
+            yield summary
+        async for summary in iter_summaries(aiter_documents(list(changed_files)),
+                                            get_summary_workers(), changed_files):
+            yield summary
+        await asyncio.to_thread(db.flush)
+
+    done = 0
+    async for summary in all_summaries():
+        done += 1
+        # Convert path to relative path
+        yield {"event": "summary", "file_path": os.path.relpath(summary["file_path"], path),
+               "summary": summary["summary"], "done": done, "total": total}
 
 
 async def get_dir_summaries(path: str, recursive: bool, required_exts: list):
-    doc_dicts = load_documents(path, recursive, required_exts)
-    await remove_deleted_files()
-    files_summaries = await get_summaries(doc_dicts)
+    return [{"file_path": event["file_path"], "summary": event["summary"]}
+            async for event in iter_dir_summaries(path, recursive, required_exts) if event["event"] == "summary"]
+
+
+def is_hidden(path: str):
+    # Whether path is hidden or in a hidden folder of the indexed root holding it, list_files skips these
+    for root in indexer.roots:
+        path_prefix = os.path.join(root, "")
+        if path.startswith(path_prefix):
+            return any(part.startswith(".") for part in path[len(path_prefix):].split(os.sep))
+    return os.path.basename(path).startswith(".")
+
+
+def has_required_ext(file_path: str, required_exts: list):
+    return not is_hidden(file_path) and os.path.splitext(file_path)[1].lower() in required_exts
 
-    # Convert path to relative path
-    for summary in files_summaries:
-        summary["file_path"] = os.path.relpath(summary["file_path"], path)
 
-    return files_summaries
+def move_file_record(src_file, dst_file):
+    if db.move_file(src_file, dst_file, get_file_stat(dst_file)):
+        index.rename(src_file, dst_file)
+        return True
+    return False
+
+
+async def apply_file_events(events: dict, required_exts: list):
+    # events: {path: ("changed",) | ("deleted",) | ("moved", dest_path) | ("dir",) | ("deleted_dir",)}
+    changed_files = []
+    deleted_files = []
+    for path, event in events.items():
+        if event[0] == "moved":
+            # A renamed file keeps its summary, otherwise it is indexed like a new file
+            if not has_required_ext(event[1], required_exts) or not os.path.isfile(event[1]):
+                deleted_files.append(path)
+            elif not await asyncio.to_thread(move_file_record, path, event[1]):
+                changed_files.append(event[1])
+        elif event[0] == "deleted":
+            deleted_files.append(path)
+        elif event[0] == "dir":
+            if not is_hidden(path):
+                await get_dir_summaries(path, True, required_exts)
+        elif event[0] == "deleted_dir":
+            for file_path in await asyncio.to_thread(db.delete_records_under, os.path.join(path, "")):
+                index.remove(file_path)
+        elif has_required_ext(path, required_exts) and os.path.isfile(path):
+            changed_files.append(path)
+    if deleted_files:
+        await asyncio.to_thread(db.delete_records, deleted_files)
+        for file_path in deleted_files:
+            index.remove(file_path)
+    if changed_files:
+        files = {file_path: get_file_stat(file_path) for file_path in changed_files if os.path.isfile(file_path)}
+        _, changed_files = await asyncio.to_thread(split_changed_files, files)
+        async for summary in iter_summaries(aiter_documents(list(changed_files)),
+                                            get_summary_workers(), changed_files):
+            pass
+        await asyncio.to_thread(db.flush)
+    logger.info(f"Indexed {len(changed_files)} changed and {len(deleted_files)} deleted files")
+
+
+indexer = Lazy(lambda: Indexer(model.settings.INDEXER_ROOTS, model.settings.INDEXER_RECURSIVE,
+                               model.settings.INDEXER_EXTS, scan=get_dir_summaries, apply_events=apply_file_events,
+                               debounce=model.settings.INDEXER_DEBOUNCE,
+                               poll_interval=model.settings.INDEXER_POLL_INTERVAL))
+
+
+async def stream_chunk_results(summary_events, iter_api, event_name: str, forward_summaries: bool = True):
+    # Feed summaries to the model as they arrive and interleave model results with the summary events
+    events = asyncio.Queue()
+
+    async def summaries():
+        async for event in summary_events:
+            if event["event"] == "summary" and not forward_summaries:
+                await events.put({"event": "progress", "done": event["done"], "total": event["total"]})
+            else:
+                await events.put(event)
+            if event["event"] == "summary":
+                yield {"file_path": event["file_path"], "summary": event["summary"]}
+
+    async def consume():
+        try:
+            async for results in iter_api(summaries()):
+                await events.put({"event": event_name, "items": results})
+        finally:
+            await events.put(None)
+
+    task = asyncio.create_task(consume())
+    try:
+        while (event := await events.get()) is not None:
+            yield event
+        await task
+        yield {"event": "done"}
+    finally:
+        task.cancel()
+
+
+async def get_summary_vectors(root_path: str, summaries: list):
+    # Embeddings of the summaries when an embedding model is configured, hashed bag of words vectors otherwise
+    from . import clustering
+
+    if model.EMBEDDING_MODEL_NAME:
+        file_paths = [os.path.join(root_path, summary["file_path"]) for summary in summaries]
+        await embed_missing(set(file_paths))
+        vectors = index.get_vectors(file_paths)
+        if vectors is not None:
+            return vectors
+    return await asyncio.to_thread(clustering.text_vectors,
+                                   [summary["file_path"] + " " + (summary["summary"] or "") for summary in summaries])
+
+
+def get_summaries_fingerprint(summaries: list):
+    # Summaries arrive in completion order, the same set of summaries has the same fingerprint
+    return fingerprint(sorted((summary["file_path"], summary["summary"] or "") for summary in summaries))
+
+
+async def iter_file_tree(root_path: str, summaries):
+    if not model.settings.FILE_TREE_HIERARCHICAL:
+        # Chunks are proposed as the summaries arrive, before the whole set is known to look up the cache
+        async for files in model.iter_file_tree_api(summaries):
+            yield files
+        return
+    summaries = [summary async for summary in iterate(summaries)]
+    if not summaries:
+        return
+    async for files in iter_cached_file_tree(root_path, summaries):
+        yield files
+
+
+async def iter_cached_file_tree(root_path: str, summaries: list):
+    # The tree proposed for the same summaries is reused, unless an API call failed while proposing it
+    summaries_fingerprint = await asyncio.to_thread(get_summaries_fingerprint, summaries)
+    files = tree_results.get(root_path, summaries_fingerprint)
+    if files is not None:
+        yield files
+        return
+    files = []
+    with track_failures() as failures:
+        if model.settings.FILE_TREE_HIERARCHICAL:
+            chunks = iter_grouped_file_tree(root_path, summaries)
+        else:
+            chunks = model.iter_file_tree_api(summaries)
+        async for chunk in chunks:
+            files.extend(chunk)
+            yield chunk
+    if not failures:
+        tree_results.put(root_path, summaries_fingerprint, files)
+
+
+async def iter_grouped_file_tree(root_path: str, summaries: list):
+    # Map-reduce over big directories: the summaries are grouped by similarity, the top level folders are proposed
+    # once from examples of every group, then each group is organized along these folders. Chunks of similar files
+    # following the same folders give a consistent tree, instead of every chunk inventing its own.
+    from . import clustering
+
+    chunks_count = await model.count_file_tree_chunks(summaries)
+    if chunks_count == 1:
+        async for files in model.iter_file_tree_api(summaries):
+            yield files
+        return
+    vectors = await get_summary_vectors(root_path, summaries)
+    groups = await asyncio.to_thread(clustering.cluster, vectors,
+                                     min(model.settings.FILE_TREE_MAX_GROUPS, chunks_count))
+    groups = [[summaries[i] for i in group] for group in groups]
+    folders = await model.create_folders_api(groups)
+    logger.info(f"{len(summaries)} files in {len(groups)} groups, {len(folders)} top level folders")
+    async for files in model.iter_file_tree_groups_api(groups, folders):
+        yield files
+
+
+async def create_file_tree(root_path: str, summaries: list):
+    if not summaries:
+        return []
+    return [file async for files in iter_cached_file_tree(root_path, summaries) for file in files]
 
 
 async def run(directory_path: str, recursive: bool, required_exts: list):
+    # Identical requests arriving while one is running share its result
+    key = (directory_path, recursive, tuple(sorted(required_exts)))
+    return await files_flight.run(key, lambda: propose_file_tree(directory_path, recursive, required_exts))
+
+
+async def propose_file_tree(directory_path: str, recursive: bool, required_exts: list):
     logger.info("Starting ...")
 
     summaries = await get_dir_summaries(directory_path, recursive, required_exts)
-    files = await model.create_file_tree_api(summaries)
+    files = await create_file_tree(directory_path, summaries)
 
     # Recursively create dictionary from file paths
     tree = {}
@@ -124,27 +672,146 @@ async def run(directory_path: str, recursive: bool, required_exts: list):
     return files
 
 
-def update_file(root_path, item):
-    src_file = root_path + "/" + item["src_path"]
-    dst_file = root_path + "/" + item["dst_path"]
-    dst_dir = os.path.dirname(dst_file)
-    if not os.path.exists(dst_dir):
-        os.makedirs(dst_dir)
-    if os.path.isfile(src_file):
-        shutil.move(src_file, dst_file)
-        new_hash = get_file_hash(dst_file)
-        db.update_file(src_file, dst_file, new_hash)
+def iter_run(directory_path: str, recursive: bool, required_exts: list):
+    logger.info("Starting ...")
+    summary_events = iter_dir_summaries(directory_path, recursive, required_exts)
+    return stream_chunk_results(summary_events, lambda summaries: iter_file_tree(directory_path, summaries), "tree")
+
+
+mover = Lazy(lambda: FileMover(db, index, get_file_stat, model.settings.MOVE_COPY_WORKERS))
+
+
+SEARCH_MODES = ("semantic", "lexical", "hybrid")
+
+
+async def vector_search(file_paths: list, search_query: str, top_k: int):
+    # Nearest summaries to the query, as (file_path, score), None if the query can't be embedded
+    file_paths = set(file_paths)
+    await embed_missing(file_paths)
+    try:
+        query_vector = (await model.embed_api([search_query]))[0]
+    except Exception as e:
+        logger.error(f"Error while embedding the search query, falling back to the lexical search: {e}")
+        return None
+    return index.search(query_vector, file_paths, top_k)
+
+
+def lexical_search(root_path: str, file_paths: list, search_query: str, top_k: int):
+    # BM25 ranked summaries and paths, as (file_path, score). Matches of other extensions or folders of the root can
+    # rank first, so the matches are read by growing pages until top_k of file_paths are found.
+    file_paths = set(file_paths)
+    path_prefix = os.path.join(root_path, "")
+    results = []
+    limit, offset = top_k * 4, 0
+    while len(results) < top_k:
+        page = db.search_summaries(search_query, path_prefix, limit, offset)
+        results.extend((file_path, score) for file_path, score in page if file_path in file_paths)
+        if len(page) < limit:
+            break
+        offset += limit
+        limit *= 2
+    return results[:top_k]
+
 
+def fuse_rankings(rankings: list, k: int = 60):
+    # Reciprocal rank fusion of several (file_path, score) rankings
+    scores = {}
+    for ranking in rankings:
+        for rank, (file_path, _) in enumerate(ranking):
+            scores[file_path] = scores.get(file_path, 0) + 1 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
 
-async def search_files(root_path: str, recursive: bool, required_exts: list, search_query: str):
-    summaries = await get_dir_summaries(root_path, recursive, required_exts)
-    files = await model.search_files_api(summaries, search_query)
+
+async def local_search(root_path: str, summaries: list, search_query: str, search_mode: str):
+    top_k = model.settings.SEARCH_TOP_K
+    file_paths = [os.path.join(root_path, summary["file_path"]) for summary in summaries]
+    vector_candidates = None
+    if search_mode != "lexical" and model.EMBEDDING_MODEL_NAME:
+        vector_candidates = await vector_search(file_paths, search_query, top_k)
+    if search_mode == "semantic" and vector_candidates is not None:
+        candidates = vector_candidates
+    else:
+        # The lexical ranking alone when the query couldn't be embedded
+        candidates = await asyncio.to_thread(lexical_search, root_path, file_paths, search_query, top_k)
+        if vector_candidates is not None:
+            candidates = fuse_rankings([candidates, vector_candidates])[:top_k]
+    candidates = [os.path.relpath(file_path, root_path) for file_path, _ in candidates]
+    if search_mode == "lexical" or not model.settings.SEARCH_RERANK:
+        return [{"file": file_path} for file_path in candidates]
+    # Let the LLM keep only the relevant candidates
+    summaries_by_path = {summary["file_path"]: summary for summary in summaries}
+    matches = await model.search_files_api([summaries_by_path[file_path] for file_path in candidates], search_query)
+    matches = {match["file"] for match in matches}
+    return [{"file": file_path} for file_path in candidates if file_path in matches]
+
+
+def is_llm_search(search_mode: str):
+    # Without embeddings, the semantic search asks the LLM over all the summaries
+    return search_mode == "semantic" and not model.EMBEDDING_MODEL_NAME
+
+
+async def search_summaries(root_path: str, summaries: list, search_query: str, search_mode: str):
+    key = (root_path, search_query, search_mode)
+    summaries_fingerprint = await asyncio.to_thread(get_summaries_fingerprint, summaries)
+    files = search_results.get(key, summaries_fingerprint)
+    if files is not None:
+        return files
+    with track_failures() as failures:
+        if is_llm_search(search_mode):
+            files = await model.search_files_api(summaries, search_query)
+        else:
+            files = await local_search(root_path, summaries, search_query, search_mode)
+    if not failures:
+        search_results.put(key, summaries_fingerprint, files)
     return files
 
 
+async def search_files(root_path: str, recursive: bool, required_exts: list, search_query: str,
+                       search_mode: str = "semantic"):
+    # Identical requests arriving while one is running share its result
+    key = (root_path, recursive, tuple(sorted(required_exts)), search_query, search_mode)
+
+    async def search():
+        summaries = await get_dir_summaries(root_path, recursive, required_exts)
+        return await search_summaries(root_path, summaries, search_query, search_mode)
+    return await search_flight.run(key, search)
+
+
+async def iter_search_files(root_path: str, recursive: bool, required_exts: list, search_query: str,
+                            search_mode: str = "semantic"):
+    summary_events = iter_dir_summaries(root_path, recursive, required_exts)
+    if is_llm_search(search_mode):
+        async for event in stream_chunk_results(
+                summary_events, lambda summaries: model.iter_search_files_api(summaries, search_query), "files",
+                forward_summaries=False):
+            yield event
+        return
+    summaries = []
+    async for event in summary_events:
+        if event["event"] == "summary":
+            summaries.append({"file_path": event["file_path"], "summary": event["summary"]})
+            yield {"event": "progress", "done": event["done"], "total": event["total"]}
+        else:
+            yield event
+    yield {"event": "files", "items": await search_summaries(root_path, summaries, search_query, search_mode)}
+    yield {"event": "done"}
+
+
+def get_file_stat(file_path):
+    stat = os.stat(file_path)
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
 def get_file_hash(file_path):
     hash_func = hashlib.new('sha256')
-    with open(file_path, 'rb') as f:
+    with metrics.timed("hash"), open(file_path, 'rb') as f:
         while chunk := f.read(8192):
             hash_func.update(chunk)
     return hash_func.hexdigest()
+
+
+jobs = Lazy(lambda: JobManager(db, {
+    "files": lambda params: iter_run(params["root_path"], params["recursive"], params["required_exts"]),
+    "search": lambda params: iter_search_files(params["root_path"], params["recursive"], params["required_exts"],
+                                               params["search_query"], params.get("search_mode", "semantic")),
+}, workers=model.settings.JOB_WORKERS))
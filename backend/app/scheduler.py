@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import random
+import time
+
+from . import metrics
+from .cache import record_failure
+
+logger = logging.getLogger()
+
+
+async def iterate(items):
+    # Accept both lists and async generators of items
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+async def iter_bounded(awaitables, max_pending: int):
+    # Run the awaitables of a (async) iterable concurrently, at most max_pending at a time,
+    # results are yielded as soon as they are ready
+    pending = set()
+    try:
+        async for awaitable in iterate(awaitables):
+            pending.add(asyncio.ensure_future(awaitable))
+            if len(pending) >= max_pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        # Consumer stopped early (ex, client disconnected) or an error occurred
+        for task in pending:
+            task.cancel()
+
+
+class TokenBucket:
+    # A per_minute of 0 disables the limit
+    def __init__(self, per_minute: int):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        if not self.rate:
+            return 0
+        self.refill()
+        # A request bigger than the bucket would never fit, let it go once the bucket is full
+        amount = min(amount, self.capacity)
+        return max(0, (amount - self.tokens) / self.rate)
+
+    def consume(self, amount):
+        if self.rate:
+            self.refill()
+            self.tokens -= amount
+
+
+class ApiKey:
+    def __init__(self, api_key: str, client, requests_per_minute: int, tokens_per_minute: int):
+        self.api_key = api_key
+        self.client = client
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.in_flight = 0
+        self.blocked_until = 0
+
+    def wait_time(self, tokens):
+        return max(self.blocked_until - time.monotonic(), self.requests.wait_time(1), self.tokens.wait_time(tokens))
+
+
+def get_status_code(error):
+    return getattr(getattr(error, "response", None), "status_code", None)
+
+
+def get_retry_after(error):
+    # Both openai and requests errors expose the http response with its headers
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class Scheduler:
+    """
+    Dispatch API calls over a pool of keys: bounded number of requests in flight, per key requests/min and
+    tokens/min buckets, least loaded key selection and exponential backoff with jitter between retries.
+    """
+
+    def __init__(self, keys: list, max_in_flight: int, max_retries: int = 5, base_delay: float = 1,
+                 max_delay: float = 60, name: str = ""):
+        self.keys = keys
+        self.name = name
+        # Metrics label of each key, the key itself is never exposed
+        self.key_labels = {id(key): str(i) for i, key in enumerate(keys)}
+        self.waiting = 0
+        self.in_flight = 0
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens):
+        # Requests are served in arrival order, each one waits for the first key able to take it
+        async with self.lock:
+            while True:
+                key = min(self.keys, key=lambda k: (k.wait_time(tokens), k.in_flight))
+                wait = key.wait_time(tokens)
+                if wait <= 0:
+                    break
+                with metrics.timed("throttle"):
+                    await asyncio.sleep(wait)
+            key.requests.consume(1)
+            key.tokens.consume(tokens)
+            key.in_flight += 1
+            metrics.LLM_TOKENS.inc(tokens, api=self.name, key=self.key_labels[id(key)])
+            return key
+
+    def update_queue_metrics(self, waiting: int, in_flight: int):
+        self.waiting += waiting
+        self.in_flight += in_flight
+        metrics.QUEUE_DEPTH.set(self.waiting, queue=f"llm_{self.name}")
+        metrics.LLM_IN_FLIGHT.set(self.in_flight, api=self.name)
+
+    async def run(self, request, tokens: int = 0, max_retries: int = None):
+        """Call `await request(key)` until it succeeds, the last error is raised once retries are exhausted."""
+        max_retries = max_retries or self.max_retries
+        attempt = 0
+        while True:
+            self.update_queue_metrics(1, 0)
+            try:
+                await self.semaphore.acquire()
+            finally:
+                self.update_queue_metrics(-1, 0)
+            try:
+                key = await self.acquire(tokens)
+                self.update_queue_metrics(0, 1)
+                start = time.perf_counter()
+                key_label = self.key_labels[id(key)]
+                try:
+                    result = await request(key)
+                    metrics.LLM_REQUESTS.inc(api=self.name, key=key_label, outcome="ok")
+                    return result
+                except Exception as e:
+                    attempt += 1
+                    outcome = "rate_limited" if get_status_code(e) == 429 else "error"
+                    metrics.LLM_REQUESTS.inc(api=self.name, key=key_label, outcome=outcome)
+                    logger.error("Error {}".format(e))
+                    if attempt >= max_retries:
+                        record_failure()
+                        raise
+                    retry_after = get_retry_after(e)
+                    delay = retry_after or min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+                    delay *= random.uniform(1, 1.5) if retry_after else random.uniform(0.5, 1)
+                    # Keep other requests off this key while it cools down
+                    key.blocked_until = time.monotonic() + delay
+                finally:
+                    key.in_flight -= 1
+                    self.update_queue_metrics(0, -1)
+                    seconds = time.perf_counter() - start
+                    metrics.LLM_SECONDS.observe(seconds, api=self.name)
+                    metrics.observe_stage("llm", seconds)
+            finally:
+                self.semaphore.release()
+            with metrics.timed("backoff"):
+                await asyncio.sleep(delay)
+
+
+class Batcher:
+    """
+    Group items submitted concurrently into batches. A batch is sent once it holds max_size items or max_tokens,
+    or max_delay seconds after its first item arrived. run_batch takes a list of items and returns their results
+    in the same order, each submitter gets its own result or the error of the whole batch.
+    """
+
+    def __init__(self, run_batch, max_size: int, max_tokens: int, max_delay: float = 0.1):
+        self.run_batch = run_batch
+        self.max_size = max_size
+        self.max_tokens = max_tokens
+        self.max_delay = max_delay
+        self.pending = []
+        self.pending_tokens = 0
+        self.timer = None
+        self.tasks = set()
+
+    async def submit(self, item, tokens: int):
+        if self.pending and self.pending_tokens + tokens > self.max_tokens:
+            self.flush()
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((item, future))
+        self.pending_tokens += tokens
+        if len(self.pending) >= self.max_size or self.pending_tokens >= self.max_tokens:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_delay, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending, self.pending_tokens = self.pending, [], 0
+        if batch:
+            task = asyncio.create_task(self.run(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run(self, batch: list):
+        try:
+            results = await self.run_batch([item for item, _ in batch])
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
@@ -1,13 +1,35 @@
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from .run import run, update_file, search_files
+from .run import run, search_files, iter_run, iter_search_files, SEARCH_MODES, model, db, indexer, jobs, mover
+from contextlib import asynccontextmanager
+from . import extractors
+from . import images
+from . import metrics
+import time
 import os
+import asyncio
+import json
 import subprocess
 import platform
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse, PlainTextResponse
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Settings, API clients and the database are created at startup rather than when the app is imported
+    model.lazy_init()
+    await asyncio.to_thread(db.lazy_init)
+    indexer.start()
+    await jobs.start()
+    yield
+    await jobs.stop()
+    await indexer.stop()
+    images.pool.shutdown()
+    extractors.pool.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -16,23 +38,62 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-app.mount("/static", StaticFiles(directory="app/static"), name="static")
+
+@app.middleware("http")
+async def record_request_duration(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # Route template rather than the raw url, to keep the number of series bounded
+    route = request.scope.get("route")
+    metrics.HTTP_SECONDS.observe(time.perf_counter() - start, method=request.method,
+                                 path=route.path if route is not None else "other")
+    return response
+
+
+@app.get("/metrics")
+def get_metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 
 @app.get('/')
 def get_angular_app():
-    return FileResponse("app/static/index.html")
+    return FileResponse(os.path.join(STATIC_DIR, "index.html"))
 
 
 @app.get("/get_files")
-async def get_files(root_path: str, recursive: bool, required_exts: str):
+async def get_files(root_path: str, recursive: bool, required_exts: str, timing: bool = False):
+    # timing: add the time spent in each stage (walk, parse, hash, db, llm) to the response
     if not os.path.exists(root_path):
         return HTTPException(status_code=404, detail=f"Path doesn't exist: {root_path}")
     required_exts = required_exts.split(';')
-    files = await run(root_path, recursive, required_exts)
-    return {
+    with metrics.track_request_timings() as timings:
+        files = await run(root_path, recursive, required_exts)
+    response = {
         "root_path": root_path,
         "items": files
     }
+    if timing:
+        response["timing"] = timings
+    return response
+
+
+async def to_ndjson(events):
+    async for event in events:
+        yield json.dumps(event) + "\n"
+
+
+@app.get("/get_files_stream")
+async def get_files_stream(root_path: str, recursive: bool, required_exts: str):
+    # Same as /get_files, but streams summaries, progress and tree chunks as newline delimited json events
+    if not os.path.exists(root_path):
+        raise HTTPException(status_code=404, detail=f"Path doesn't exist: {root_path}")
+    required_exts = required_exts.split(';')
+    return StreamingResponse(to_ndjson(iter_run(root_path, recursive, required_exts)),
+                             media_type="application/x-ndjson")
 
 
 @app.post("/update_files")
@@ -40,12 +101,47 @@ async def update_files(request: Request):
     data = await request.json()
     root_path = data.get('root_path')
     items = data.get('items')
-    for item in items:
-        try:
-            update_file(root_path, item)
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error while moving file: {e}")
-    return {"message": "Files moved successfully"}
+    try:
+        result = await asyncio.to_thread(mover.move, root_path, items)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error while moving file: {e}")
+    if result["status"] == "failed":
+        # The moves done are kept, the journal can be resumed or rolled back
+        raise HTTPException(status_code=500, detail={"message": "Error while moving files", **result})
+    if not result["moved"] and result["skipped"]:
+        raise HTTPException(status_code=400, detail={"message": "No file moved", **result})
+    return {"message": "Files moved successfully", **result}
+
+
+@app.get("/moves")
+async def get_moves():
+    # Reorganizations that failed or were interrupted, to resume or roll back
+    move_ids = await asyncio.to_thread(db.get_move_ids, ("planned", "running", "failed"))
+    return [await asyncio.to_thread(mover.get, move_id) for move_id in move_ids]
+
+
+@app.get("/moves/{move_id}")
+async def get_move(move_id: str):
+    move = await asyncio.to_thread(mover.get, move_id)
+    if move is None:
+        raise HTTPException(status_code=404, detail=f"Unknown move: {move_id}")
+    return move
+
+
+@app.post("/moves/{move_id}/resume")
+async def resume_move(move_id: str):
+    move = await asyncio.to_thread(mover.resume, move_id)
+    if move is None:
+        raise HTTPException(status_code=404, detail=f"Unknown move: {move_id}")
+    return move
+
+
+@app.post("/moves/{move_id}/rollback")
+async def rollback_move(move_id: str):
+    move = await asyncio.to_thread(mover.rollback, move_id)
+    if move is None:
+        raise HTTPException(status_code=404, detail=f"Unknown move: {move_id}")
+    return move
 
 
 @app.post("/open_file")
@@ -59,23 +155,95 @@ async def open_file(request: Request):
         if current_os == "Windows":
             os.startfile(file_path)
         elif current_os == "Darwin":
-            subprocess.run(["open", file_path])
+            await asyncio.to_thread(subprocess.run, ["open", file_path])
         elif current_os == "Linux":
-            subprocess.run(["xdg-open", file_path])
+            await asyncio.to_thread(subprocess.run, ["xdg-open", file_path])
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error while opening file: {e}")
     return {"message": "Files opened successfully"}
 
 
 @app.get("/search_files")
-async def get_search_files(root_path: str, recursive: bool, required_exts: str, search_query: str):
+async def get_search_files(root_path: str, recursive: bool, required_exts: str, search_query: str,
+                           search_mode: str = "semantic", timing: bool = False):
+    # search_mode: "semantic" (embeddings or LLM), "lexical" (BM25 full text index) or "hybrid" (both fused)
     if not os.path.exists(root_path):
         return HTTPException(status_code=404, detail=f"Path doesn't exist: {root_path}")
+    if search_mode not in SEARCH_MODES:
+        raise HTTPException(status_code=400, detail=f"Unknown search mode: {search_mode}")
     required_exts = required_exts.split(';')
-    files = await search_files(root_path, recursive, required_exts, search_query)
+    with metrics.track_request_timings() as timings:
+        files = await search_files(root_path, recursive, required_exts, search_query, search_mode)
+    if timing:
+        return {"files": files, "timing": timings}
     return files
 
 
+@app.get("/search_files_stream")
+async def get_search_files_stream(root_path: str, recursive: bool, required_exts: str, search_query: str,
+                                  search_mode: str = "semantic"):
+    if not os.path.exists(root_path):
+        raise HTTPException(status_code=404, detail=f"Path doesn't exist: {root_path}")
+    if search_mode not in SEARCH_MODES:
+        raise HTTPException(status_code=400, detail=f"Unknown search mode: {search_mode}")
+    required_exts = required_exts.split(';')
+    return StreamingResponse(to_ndjson(iter_search_files(root_path, recursive, required_exts, search_query,
+                                                         search_mode)),
+                             media_type="application/x-ndjson")
+
+
+@app.post("/jobs")
+async def submit_job(request: Request):
+    # Runs /get_files ("files") or /search_files ("search") in the background, returns the job id to poll
+    data = await request.json()
+    kind = data.get('kind', 'files')
+    root_path = data.get('root_path')
+    if not root_path or not os.path.exists(root_path):
+        raise HTTPException(status_code=404, detail=f"Path doesn't exist: {root_path}")
+    params = {"root_path": root_path, "recursive": bool(data.get('recursive', True)),
+              "required_exts": data.get('required_exts', '').split(';')}
+    if kind == "search":
+        if data.get('search_mode', 'semantic') not in SEARCH_MODES:
+            raise HTTPException(status_code=400, detail=f"Unknown search mode: {data.get('search_mode')}")
+        params["search_query"] = data.get('search_query', '')
+        params["search_mode"] = data.get('search_mode', 'semantic')
+    try:
+        job_id = await jobs.submit(kind, params)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"job_id": job_id}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return job
+
+
+@app.get("/jobs/{job_id}/results")
+async def get_job_results(job_id: str, offset: int = 0, limit: int = 1000):
+    job = await jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    items = await jobs.get_results(job_id, offset, limit)
+    return {
+        "root_path": job["params"]["root_path"],
+        "status": job["status"],
+        "items": items,
+        "next_offset": offset + len(items)
+    }
+
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    job = await jobs.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return job
+
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -1,13 +1,13 @@
-import time
-
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from openai import AsyncOpenAI
 import base64
+import functools
 import logging
 import json
-import sys
-import requests
-import logging
+import asyncio
+import threading
+
+from .scheduler import ApiKey, Batcher, Scheduler, iterate, iter_bounded
+from . import metrics
 
 logger = logging.getLogger()
 
@@ -20,84 +20,305 @@ class Settings(BaseSettings):
     IMAGE_API_END_POINT: str
     IMAGE_MODEL_NAME: str
     IMAGE_API_KEYS: list[str]
+    # Context window of the text model, summaries sent to create the file tree or search are packed to fit in it
+    TEXT_CONTEXT_WINDOW: int = 8192
+    # tiktoken encoding used to count tokens, falls back to an estimate when tiktoken is not available
+    TOKENIZER_ENCODING: str = "cl100k_base"
+    # Directories needing more than one request to propose their file tree are grouped by similarity: top level
+    # folders are proposed once from examples of each group, then the groups are organized concurrently along them
+    FILE_TREE_HIERARCHICAL: bool = True
+    FILE_TREE_MAX_GROUPS: int = 32
+    # Number of background jobs processed at the same time
+    JOB_WORKERS: int = 2
+    # Files copied at the same time by /update_files when moving across file systems
+    MOVE_COPY_WORKERS: int = 4
+    # Folders indexed in the background when the server starts, so that requests on them read a warm index
+    INDEXER_ROOTS: list[str] = []
+    INDEXER_RECURSIVE: bool = True
+    INDEXER_EXTS: list[str] = [".csv", ".docx", ".ipynb", ".jpeg", ".jpg", ".md", ".mp3", ".mp4", ".pdf", ".png",
+                               ".ppt", ".txt"]
+    INDEXER_DEBOUNCE: float = 2
+    INDEXER_POLL_INTERVAL: float = 60
+    # Defaults to backend/FileWizardAi.db
+    DB_PATH: str = ""
+    # API calls scheduling, a limit of 0 means no limit
+    MAX_CONCURRENT_REQUESTS: int = 8
+    MAX_RETRIES: int = 5
+    TEXT_REQUESTS_PER_MINUTE: int = 0
+    TEXT_TOKENS_PER_MINUTE: int = 0
+    IMAGE_REQUESTS_PER_MINUTE: int = 0
+    IMAGE_TOKENS_PER_MINUTE: int = 0
+    # Small documents are summarized together, up to SUMMARY_BATCH_MAX_FILES files and SUMMARY_BATCH_MAX_TOKENS tokens
+    # per request. Documents above SUMMARY_BATCH_FILE_TOKENS get a request of their own, 1 file disables batching.
+    SUMMARY_BATCH_MAX_FILES: int = 20
+    SUMMARY_BATCH_MAX_TOKENS: int = 4096
+    SUMMARY_BATCH_FILE_TOKENS: int = 512
+    # Images are downsized to the resolution the image model actually uses before being sent, in worker processes.
+    # IMAGE_MAX_IN_MEMORY bounds the prepared images waiting for or being sent to the API.
+    IMAGE_MAX_SIDE: int = 1024
+    IMAGE_QUALITY: int = 85
+    IMAGE_WORKERS: int = 2
+    IMAGE_MAX_IN_MEMORY: int = 4
+    # Processes reading the beginning of text documents (pdf, docx, pptx, notebooks, text files)
+    EXTRACT_WORKERS: int = 2
+    # Embeddings used by the vector search, an empty model name falls back to asking the LLM over all summaries.
+    # Endpoint and keys default to the text ones.
+    EMBEDDING_API_END_POINT: str = ""
+    EMBEDDING_MODEL_NAME: str = ""
+    EMBEDDING_API_KEYS: list[str] = []
+    SEARCH_TOP_K: int = 20
+    SEARCH_RERANK: bool = True
+    # File trees and search results kept for directories whose summaries didn't change, 0 disables the cache
+    RESULT_CACHE_SIZE: int = 64
+
+
+@functools.lru_cache(maxsize=1)
+def get_encoding(encoding_name):
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        # Not installed, or its vocabulary can't be downloaded
+        logger.warning("tiktoken not available ({}), token counts are estimated".format(e))
+        return None
+
+
+def count_tokens(text: str, encoding_name: str = "cl100k_base"):
+    encoding = get_encoding(encoding_name)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+FILE_TREE_PROMPT = """
+You will be provided with list of source files and a summary of their contents.
+For each file,propose a new path and filename, using a directory structure that optimally organizes the files using known conventions and best practices.
+Follow good naming conventions. Here are a few guidelines
+- Think about your files : What related files are you working with?
+- Identify metadata (for example, date, sample, experiment) : What information is needed to easily locate a specific file?
+- Abbreviate or encode metadata
+- Use versioning : Are you maintaining different versions of the same file?
+- Think about how you will search for your files : What comes first?
+- Deliberately separate metadata elements : Avoid spaces or special characters in your file names
+If the file is already named well or matches a known convention, set the destination path to the same as the source path.
+
+Your response must be a JSON object with the following schema, dont add any extra text except the json:
+```json
+{
+    "files": [
+        {
+            "src_path": "original file path",
+            "dst_path": "new file path under proposed directory structure with proposed file name"
+        }
+    ]
+}
+```
+""".strip()
+
+FOLDERS_PROMPT = """
+You will be provided with groups of similar files from a directory, with the number of files of each group and a few example files with a summary of their contents.
+Propose the top level folders of a directory structure that optimally organizes all the files of the directory, using known conventions and best practices.
+Folders can be nested up to two levels, the files of every group must belong in one of the folders. Follow good naming conventions, avoid spaces or special characters in folder names.
+
+Your response must be a JSON object with the following schema, dont add any extra text except the json:
+```json
+{
+    "folders": [
+        {
+            "path": "folder path",
+            "description": "files that belong in this folder"
+        }
+    ]
+}
+```
+""".strip()
+
+FILE_TREE_FOLDERS_PROMPT = """
+The files are part of a bigger directory organized with the following folders, put every file in one of them or in a new subfolder of one of them:
+{folders}
+""".strip()
+
+BATCH_SUMMARY_PROMPT = """
+You will be provided with a list of files, each with an id, a file name and its contents. Provide a summary of the contents of each file.
+The purpose of the summaries is to organize files based on their content.
+To this end provide a concise but informative summary for each file. Make each summary as specific to its file as possible.
+
+Your response must be a JSON object with the following schema, dont add any extra text except the json:
+```json
+{
+    "files": [
+        {
+            "id": "id of the file",
+            "summary": "summary of the file contents"
+        }
+    ]
+}
+```
+""".strip()
+
+SEARCH_FILES_PROMPT = """
+You will be provided with list of source files and a summary of their contents:
+return the files that matches or have a similar content to this search query: {search_query}
+
+Your response must be a JSON object with the following schema, dont add any extra text except the json:
+```json
+{{
+"files": [
+        {{
+            "file": "File that matches or have a similar content to the search query"
+        }}
+    ]
+}}
+""".strip()
+
+
+def parse_batch_summaries(result: str, count: int):
+    # Returns {id: summary} for the valid entries of a batch answer, a malformed answer gives no summary
+    try:
+        # case when llm doesn't support llama json template
+        files = json.loads(result.replace("```json", "").replace("```", "").strip())["files"]
+    except (ValueError, KeyError, TypeError) as e:
+        logger.error("Invalid batch summaries: {}".format(e))
+        return {}
+    summaries = {}
+    for file in files if isinstance(files, list) else []:
+        try:
+            file_id = int(file["id"])
+        except (ValueError, KeyError, TypeError):
+            continue
+        summary = file.get("summary")
+        if 0 <= file_id < count and isinstance(summary, str) and summary.strip():
+            summaries[file_id] = summary.strip()
+    return summaries
+
+
+class Lazy:
+    """
+    Stands for an object built on first use, so that importing the app doesn't read the .env file,
+    create the API clients or open the database. lazy_init() builds it explicitly, ex at server startup.
+    """
+
+    def __init__(self, factory):
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_object", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    def lazy_init(self):
+        if self._object is None:
+            with self._lock:
+                if self._object is None:
+                    object.__setattr__(self, "_object", self._factory())
+        return self._object
+
+    def __getattr__(self, name):
+        return getattr(self.lazy_init(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.lazy_init(), name, value)
 
 
 class Model:
-    settings = Settings()
-
-    TEXT_API_END_POINT = settings.TEXT_API_END_POINT
-    TEXT_MODEL_NAME = settings.TEXT_MODEL_NAME
-    TEXT_API_KEYS = settings.TEXT_API_KEYS
-    IMAGE_API_END_POINT = settings.IMAGE_API_END_POINT
-    IMAGE_MODEL_NAME = settings.IMAGE_MODEL_NAME
-    IMAGE_API_KEYS = settings.IMAGE_API_KEYS
-    text_keys_count = len(TEXT_API_KEYS)
-    image_keys_count = len(IMAGE_API_KEYS)
-    MAX_TOKEN_SIZE = 4000 # Increase or decrease based on the model context window size
-    cnt_txt = 0
-    cnt_img = 0
+    # Bump when a summary prompt changes, summaries made with another model or prompt are not reused
+    TEXT_PROMPT_VERSION = 1
+    IMAGE_PROMPT_VERSION = 1
+    # Rough size of an image in the tokens/min budget
+    IMAGE_TOKENS = 1000
 
     def __init__(self):
-        self.async_text_clients = [AsyncOpenAI(base_url=self.TEXT_API_END_POINT, api_key=api_key)
-                                   for api_key in self.TEXT_API_KEYS]
-        self.async_image_clients = [AsyncOpenAI(base_url=self.IMAGE_API_END_POINT, api_key=api_key)
-                                    for api_key in self.IMAGE_API_KEYS]
+        # openai and httpx take most of the startup time, they are only imported when the model is created
+        from openai import AsyncOpenAI
+        import httpx
+
+        self.settings = settings = Settings()
+        self.TEXT_API_END_POINT = settings.TEXT_API_END_POINT
+        self.TEXT_MODEL_NAME = settings.TEXT_MODEL_NAME
+        self.TEXT_API_KEYS = settings.TEXT_API_KEYS
+        self.IMAGE_API_END_POINT = settings.IMAGE_API_END_POINT
+        self.IMAGE_MODEL_NAME = settings.IMAGE_MODEL_NAME
+        self.IMAGE_API_KEYS = settings.IMAGE_API_KEYS
+        self.EMBEDDING_API_END_POINT = settings.EMBEDDING_API_END_POINT or settings.TEXT_API_END_POINT
+        self.EMBEDDING_MODEL_NAME = settings.EMBEDDING_MODEL_NAME
+        self.EMBEDDING_API_KEYS = settings.EMBEDDING_API_KEYS or settings.TEXT_API_KEYS
+        self.TEXT_SUMMARY_VERSION = f"text:{self.TEXT_MODEL_NAME}/v{self.TEXT_PROMPT_VERSION}"
+        self.IMAGE_SUMMARY_VERSION = f"image:{self.IMAGE_MODEL_NAME}/v{self.IMAGE_PROMPT_VERSION}"
+        self.http_client = httpx.AsyncClient(timeout=None)
+        self.summary_batcher = Batcher(lambda docs: self.summarize_documents_api(docs),
+                                       settings.SUMMARY_BATCH_MAX_FILES, settings.SUMMARY_BATCH_MAX_TOKENS)
+        # Prepared images held in memory, from their decoding until the API answers
+        self.image_slots = asyncio.Semaphore(settings.IMAGE_MAX_IN_MEMORY)
+        self.text_scheduler = Scheduler(
+            [ApiKey(api_key, AsyncOpenAI(base_url=self.TEXT_API_END_POINT, api_key=api_key, max_retries=0),
+                    self.settings.TEXT_REQUESTS_PER_MINUTE, self.settings.TEXT_TOKENS_PER_MINUTE)
+             for api_key in self.TEXT_API_KEYS],
+            max_in_flight=self.settings.MAX_CONCURRENT_REQUESTS,
+            max_retries=self.settings.MAX_RETRIES,
+            name="text",
+        )
+        self.image_scheduler = Scheduler(
+            [ApiKey(api_key, AsyncOpenAI(base_url=self.IMAGE_API_END_POINT, api_key=api_key, max_retries=0),
+                    self.settings.IMAGE_REQUESTS_PER_MINUTE, self.settings.IMAGE_TOKENS_PER_MINUTE)
+             for api_key in self.IMAGE_API_KEYS],
+            max_in_flight=self.settings.MAX_CONCURRENT_REQUESTS,
+            max_retries=self.settings.MAX_RETRIES,
+            name="image",
+        )
+        self.embedding_scheduler = Scheduler(
+            [ApiKey(api_key, AsyncOpenAI(base_url=self.EMBEDDING_API_END_POINT, api_key=api_key, max_retries=0),
+                    self.settings.TEXT_REQUESTS_PER_MINUTE, self.settings.TEXT_TOKENS_PER_MINUTE)
+             for api_key in self.EMBEDDING_API_KEYS],
+            max_in_flight=self.settings.MAX_CONCURRENT_REQUESTS,
+            max_retries=self.settings.MAX_RETRIES,
+            name="embedding",
+        )
 
-    async def summarize_image_api(self, image_path):
+    def count_tokens(self, messages: list):
+        return count_tokens(json.dumps(messages), self.settings.TOKENIZER_ENCODING)
+
+    async def summarize_image_api(self, image_data: bytes, mime_type: str, image_path: str = ""):
         prompt = """
         Describe this image in the most concise way possible, capturing only the essential elements and details. 
         Aim for a very brief yet accurate summary.
         """
-        attempt = 0
         summary = ""
         # Huggingface API doesn't support image completions
         if "huggingface.co" in self.IMAGE_API_END_POINT.lower():
-            # To avoid rate_limit_exceeded or api error
             endpoint_url = self.IMAGE_API_END_POINT.replace("v1", "models") + "/" + self.IMAGE_MODEL_NAME
-            while attempt < 5:
-                try:
-                    headers = {"Authorization": f"Bearer {self.IMAGE_API_KEYS[self.cnt_img % self.image_keys_count]}"}
-                    with open(image_path, "rb") as f:
-                        data = f.read()
-                        response = requests.post(endpoint_url, headers=headers, data=data)
-                    summary = response.json()[0]["generated_text"]
-                    break
-                except Exception as e:
-                    logger.error("Error {}".format(e))
-                    attempt += 1
-                    self.cnt_img += 1
+
+            async def request(key):
+                headers = {"Authorization": f"Bearer {key.api_key}", "Content-Type": mime_type}
+                response = await self.http_client.post(endpoint_url, headers=headers, content=image_data)
+                response.raise_for_status()
+                return response.json()[0]["generated_text"]
         else:
-            with open(image_path, "rb") as image_file:
-                base64_image = base64.b64encode(image_file.read()).decode('utf-8')
-            # To avoid rate_limit_exceeded or api error
-            while attempt < 5:
-                try:
-                    chat_completion = await self.async_image_clients[
-                        self.cnt_img % self.text_keys_count].chat.completions.create(
-                        model=Model.IMAGE_MODEL_NAME,
-                        messages=[
-                            {
-                                "role": "user",
-                                "content": [
-                                    {"type": "text", "text": prompt},
-                                    {
-                                        "type": "image_url",
-                                        "image_url": {
-                                            "url": f"data:image/jpeg;base64,{base64_image}"
-                                        },
-                                    },
-                                ],
-                            }
-                        ],
-                        timeout=None,
-                        temperature=0,
-                    )
-                    summary = chat_completion.choices[0].message.content
-                    break
-                except Exception as e:
-                    logger.error("Error {}".format(e))
-                    attempt += 1
-                    self.cnt_img += 1
+            base64_image = base64.b64encode(image_data).decode('ascii')
+            messages = [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": prompt},
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:{mime_type};base64,{base64_image}"
+                            },
+                        },
+                    ],
+                }
+            ]
+
+            async def request(key):
+                chat_completion = await key.client.chat.completions.create(
+                    model=self.IMAGE_MODEL_NAME,
+                    messages=messages,
+                    timeout=None,
+                    temperature=0,
+                )
+                return chat_completion.choices[0].message.content
+        # To avoid rate_limit_exceeded or api error
+        try:
+            summary = await self.image_scheduler.run(request, tokens=self.IMAGE_TOKENS)
+        except Exception as e:
+            logger.error("Error while summarizing image {}: {}".format(image_path, e))
         return summary
 
     async def summarize_document_api(self, doc_text):
@@ -107,143 +328,212 @@ class Model:
         To this end provide a concise but informative summary. Make the summary as specific to the file as possible.
         It is very important that you only provide the final output without any additional comments or remarks.
         """.strip()
-        attempt = 0
         summary = ""
+        messages = [
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": doc_text},
+        ]
+
+        async def request(key):
+            chat_completion = await key.client.chat.completions.create(
+                model=self.TEXT_MODEL_NAME,
+                messages=messages,
+                stream=False,
+                temperature=0,
+                timeout=None,
+            )
+            return chat_completion.choices[0].message.content
         # To avoid rate_limit_exceeded or api error
-        while attempt < 5:
-            try:
-                chat_completion = await self.async_text_clients[
-                    self.cnt_txt % self.text_keys_count].chat.completions.create(
-                    model=Model.TEXT_MODEL_NAME,
-                    messages=[
-                        {"role": "system", "content": prompt},
-                        {"role": "user", "content": doc_text},
-                    ],
-                    stream=False,
-                    temperature=0,
-                    timeout=None,
-                )
-                summary = chat_completion.choices[0].message.content
-                break
-            except Exception as e:
-                logger.error("Error {}".format(e))
-                attempt += 1
-                self.cnt_txt += 1
+        try:
+            summary = await self.text_scheduler.run(request, tokens=self.count_tokens(messages))
+        except Exception as e:
+            logger.error("Error while summarizing document: {}".format(e))
         return summary
 
-    async def create_file_tree_api(self, summaries: list):
+    async def summarize_text(self, doc_text: str, file_name: str = ""):
+        # Small documents are sent in batches, the others get a request of their own
+        if self.settings.SUMMARY_BATCH_MAX_FILES > 1:
+            doc = {"file_name": file_name, "content": doc_text}
+            tokens = count_tokens(json.dumps(doc), self.settings.TOKENIZER_ENCODING)
+            if tokens <= self.settings.SUMMARY_BATCH_FILE_TOKENS:
+                return await self.summary_batcher.submit(doc, tokens)
+        return await self.summarize_document_api(doc_text)
+
+    async def summarize_documents_api(self, docs: list):
+        # docs: list of {"file_name", "content"}, returns their summaries in the same order.
+        # Files missing from the answer, or the whole batch if the request fails, are summarized one by one.
+        metrics.SUMMARY_BATCH_SIZE.observe(len(docs))
+        if len(docs) == 1:
+            return [await self.summarize_document_api(docs[0]["content"])]
+        summaries = {}
+        messages = [
+            {"role": "system", "content": BATCH_SUMMARY_PROMPT},
+            {"role": "user", "content": json.dumps([{"id": i, **doc} for i, doc in enumerate(docs)])},
+        ]
+
+        async def request(key):
+            chat_completion = await key.client.chat.completions.create(
+                model=self.TEXT_MODEL_NAME,
+                messages=messages,
+                stream=False,
+                temperature=0,
+                timeout=None,
+            )
+            return parse_batch_summaries(chat_completion.choices[0].message.content, len(docs))
+        try:
+            summaries = await self.text_scheduler.run(request, tokens=self.count_tokens(messages))
+        except Exception as e:
+            logger.error("Error while summarizing documents: {}".format(e))
+        missing = [i for i in range(len(docs)) if not summaries.get(i)]
+        if missing:
+            logger.warning(f"{len(missing)} of {len(docs)} files missing from the batch answer, summarizing them alone")
+            for i, summary in zip(missing, await asyncio.gather(
+                    *(self.summarize_document_api(docs[i]["content"]) for i in missing))):
+                summaries[i] = summary
+        return [summaries[i] for i in range(len(docs))]
+
+    async def embed_api(self, texts: list):
+        async def request(key):
+            response = await key.client.embeddings.create(model=self.EMBEDDING_MODEL_NAME, input=texts)
+            return [item.embedding for item in response.data]
+        return await self.embedding_scheduler.run(request, tokens=self.count_tokens(texts))
+
+    def chunk_token_budget(self, prompt: str):
+        # Half of what is left of the context window is kept for the answer, which lists the files again
+        return max(256, (self.settings.TEXT_CONTEXT_WINDOW - count_tokens(prompt, self.settings.TOKENIZER_ENCODING)) // 2)
+
+    async def iter_chunks(self, summaries, prompt: str):
+        # Pack summaries into chunks that fit in the model context window, as they arrive.
+        # Each summary is counted once, 2 tokens for the list brackets and 1 per separator.
+        budget = self.chunk_token_budget(prompt)
         tmp: list = []
-        file_tree: list = []
-        for summary in summaries:
-            # it's better to use tiktoken here
-            if (sys.getsizeof(json.dumps(tmp)) + sys.getsizeof(json.dumps(summary))) / 4 >= self.MAX_TOKEN_SIZE:
-                file_tree = file_tree + await self.create_file_tree_api_chunk(tmp)
+        tmp_tokens = 2
+        async for summary in iterate(summaries):
+            tokens = count_tokens(json.dumps(summary), self.settings.TOKENIZER_ENCODING) + 1
+            if tmp and tmp_tokens + tokens > budget:
+                yield tmp
                 tmp = []
-            else:
-                tmp.append(summary)
+                tmp_tokens = 2
+            tmp.append(summary)
+            tmp_tokens += tokens
         if len(tmp) > 0:
-            file_tree = file_tree + await self.create_file_tree_api_chunk(tmp)
-        return file_tree
+            yield tmp
 
-    async def create_file_tree_api_chunk(self, summaries: list):
-        file_prompt = """
-        You will be provided with list of source files and a summary of their contents.
-        For each file,propose a new path and filename, using a directory structure that optimally organizes the files using known conventions and best practices.
-        Follow good naming conventions. Here are a few guidelines
-        - Think about your files : What related files are you working with?
-        - Identify metadata (for example, date, sample, experiment) : What information is needed to easily locate a specific file?
-        - Abbreviate or encode metadata
-        - Use versioning : Are you maintaining different versions of the same file?
-        - Think about how you will search for your files : What comes first?
-        - Deliberately separate metadata elements : Avoid spaces or special characters in your file names
-        If the file is already named well or matches a known convention, set the destination path to the same as the source path.
-
-        Your response must be a JSON object with the following schema, dont add any extra text except the json:
-        ```json
-        {
-            "files": [
-                {
-                    "src_path": "original file path",
-                    "dst_path": "new file path under proposed directory structure with proposed file name"
-                }
-            ]
-        }
-        ```
-        """.strip()
-        attempt = 0
-        file_tree = None
-        while attempt < 10:
-            try:
-                chat_completion = await self.async_text_clients[
-                    self.cnt_txt % self.text_keys_count].chat.completions.create(
-                    messages=[
-                        {"role": "system", "content": file_prompt},
-                        {"role": "user", "content": json.dumps(summaries)},
-                    ],
-                    model=self.TEXT_MODEL_NAME,
-                    stream=False,
-                    temperature=0,
-                )
-                result = chat_completion.choices[0].message.content
-                # case when llm doesn't support llama json template
-                result = result.replace("```json", "").replace("```", "").strip()
-                file_tree = json.loads(result)["files"]
+    async def iter_chunk_results(self, summaries, prompt: str, chunk_api):
+        # Chunks are sent concurrently as soon as they are packed, results come back in completion order
+        chunks = (chunk_api(chunk) async for chunk in self.iter_chunks(summaries, prompt))
+        async for result in iter_bounded(chunks, self.settings.MAX_CONCURRENT_REQUESTS):
+            yield result
+
+    def iter_file_tree_api(self, summaries):
+        return self.iter_chunk_results(summaries, FILE_TREE_PROMPT, self.create_file_tree_api_chunk)
+
+    async def create_file_tree_api(self, summaries: list):
+        return [file async for files in self.iter_file_tree_api(summaries) for file in files]
+
+    async def count_file_tree_chunks(self, summaries: list):
+        return sum([1 async for _ in self.iter_chunks(summaries, FILE_TREE_PROMPT)])
+
+    async def iter_file_tree_groups_api(self, groups: list, folders: list):
+        # Every group of similar summaries is packed into chunks of its own, all the chunks follow the same folders
+        prompt = FILE_TREE_PROMPT
+        if folders:
+            prompt += "\n\n" + FILE_TREE_FOLDERS_PROMPT.format(folders="\n".join(
+                f"- {folder['path']}: {folder.get('description', '')}" for folder in folders))
+
+        async def chunks():
+            for group in groups:
+                async for chunk in self.iter_chunks(group, prompt):
+                    yield self.create_file_tree_api_chunk(chunk, prompt)
+        async for result in iter_bounded(chunks(), self.settings.MAX_CONCURRENT_REQUESTS):
+            yield result
+
+    async def create_folders_api(self, groups: list):
+        # groups: lists of summaries, most representative first. Returns the folders [{"path", "description"}]
+        # proposed from a few examples of each group, as many as fit in a request.
+        budget = self.chunk_token_budget(FOLDERS_PROMPT)
+        for examples_count in range(5, 0, -1):
+            content = json.dumps([{"files": len(group), "examples": [
+                {"file_path": summary["file_path"], "summary": (summary["summary"] or "")[:300]}
+                for summary in group[:examples_count]]} for group in groups])
+            if count_tokens(content, self.settings.TOKENIZER_ENCODING) <= budget:
                 break
-            except Exception as e:
-                logger.error("Error {}".format(e))
-                attempt += 1
-                self.cnt_txt += 1
-                time.sleep(2)
+        folders = []
+        messages = [
+            {"role": "system", "content": FOLDERS_PROMPT},
+            {"role": "user", "content": content},
+        ]
+
+        async def request(key):
+            chat_completion = await key.client.chat.completions.create(
+                messages=messages,
+                model=self.TEXT_MODEL_NAME,
+                stream=False,
+                temperature=0,
+            )
+            result = chat_completion.choices[0].message.content
+            # case when llm doesn't support llama json template
+            result = result.replace("```json", "").replace("```", "").strip()
+            return [folder for folder in json.loads(result)["folders"]
+                    if isinstance(folder, dict) and isinstance(folder.get("path"), str)]
+        try:
+            folders = await self.text_scheduler.run(request, tokens=self.count_tokens(messages), max_retries=10)
+        except Exception as e:
+            logger.error("Error while creating folders: {}".format(e))
+        return folders
+
+    async def create_file_tree_api_chunk(self, summaries: list, prompt: str = FILE_TREE_PROMPT):
+        messages = [
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": json.dumps(summaries)},
+        ]
+
+        async def request(key):
+            chat_completion = await key.client.chat.completions.create(
+                messages=messages,
+                model=self.TEXT_MODEL_NAME,
+                stream=False,
+                temperature=0,
+            )
+            result = chat_completion.choices[0].message.content
+            # case when llm doesn't support llama json template
+            result = result.replace("```json", "").replace("```", "").strip()
+            return json.loads(result)["files"]
+        try:
+            file_tree = await self.text_scheduler.run(request, tokens=self.count_tokens(messages), max_retries=10)
+        except Exception as e:
+            logger.error("Error while creating file tree: {}".format(e))
+            # The files of the chunk stay where they are rather than missing from the tree
+            file_tree = [{"src_path": summary["file_path"], "dst_path": summary["file_path"]} for summary in summaries]
         return file_tree
 
+    def iter_search_files_api(self, summaries, search_query: str):
+        return self.iter_chunk_results(summaries, SEARCH_FILES_PROMPT.format(search_query=search_query),
+                                       lambda chunk: self.search_files_api_chunk(chunk, search_query))
+
     async def search_files_api(self, summaries: list, search_query: str):
-        tmp: list = []
-        files: list = []
-        for summary in summaries:
-            # it's better to use tiktoken here
-            if (sys.getsizeof(json.dumps(tmp)) + sys.getsizeof(json.dumps(summary))) / 4 >= self.MAX_TOKEN_SIZE:
-                files = files + await self.search_files_api_chunk(tmp, search_query)
-                tmp = []
-            else:
-                tmp.append(summary)
-        if len(tmp) > 0:
-            files = files + await self.search_files_api_chunk(tmp, search_query)
-        return files
+        return [file async for files in self.iter_search_files_api(summaries, search_query) for file in files]
 
     async def search_files_api_chunk(self, summaries: list, search_query: str):
-        file_prompt = """
-        You will be provided with list of source files and a summary of their contents:
-        return the files that matches or have a similar content to this search query: """ + search_query + """
+        files = []
+        messages = [
+            {"role": "system", "content": SEARCH_FILES_PROMPT.format(search_query=search_query)},
+            {"role": "user", "content": json.dumps(summaries)},
+        ]
 
-        Your response must be a JSON object with the following schema, dont add any extra text except the json:
-        ```json
-        {
-        "files": [
-                {
-                    "file": "File that matches or have a similar content to the search query"
-                }
-            ]
-        }
-        """.strip()
-        while True:
-            try:
-                chat_completion = await self.async_text_clients[
-                    self.cnt_txt % self.text_keys_count].chat.completions.create(
-                    messages=[
-                        {"role": "system", "content": file_prompt},
-                        {"role": "user", "content": json.dumps(summaries)},
-                    ],
-                    model=self.TEXT_MODEL_NAME,
-                    stream=False,
-                    timeout=None,
-                )
-                result = chat_completion.choices[0].message.content
-                files = json.loads(result)["files"]
-                break
-            except Exception as e:
-                logger.error("Error {}".format(e))
-                self.cnt_txt += 1
-                time.sleep(2)
+        async def request(key):
+            chat_completion = await key.client.chat.completions.create(
+                messages=messages,
+                model=self.TEXT_MODEL_NAME,
+                stream=False,
+                timeout=None,
+            )
+            result = chat_completion.choices[0].message.content
+            return json.loads(result)["files"]
+        try:
+            files = await self.text_scheduler.run(request, tokens=self.count_tokens(messages), max_retries=10)
+        except Exception as e:
+            logger.error("Error while searching files: {}".format(e))
         return files
 
 
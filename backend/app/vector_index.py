@@ -0,0 +1,102 @@
+import numpy as np
+
+
+def to_blob(vector):
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+
+def from_blob(blob):
+    return np.frombuffer(blob, dtype=np.float32)
+
+
+class VectorIndex:
+    """
+    In memory matrix of normalized summary embeddings, a search is a single matrix-vector product
+    followed by a partial sort, restricted to the requested files.
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.matrix = None
+        # File path of each row, None for the free ones
+        self.paths = None
+        self.size = 0
+        self.free_rows = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def clear(self):
+        self.__init__()
+
+    def add(self, file_path, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector = vector / norm
+        if self.matrix is None or self.matrix.shape[1] != vector.shape[0]:
+            # First vector or the embedding model changed its dimension
+            self.clear()
+            self.matrix = np.zeros((1024, vector.shape[0]), dtype=np.float32)
+            self.paths = np.full(1024, None, dtype=object)
+        row = self.rows.get(file_path)
+        if row is None:
+            if self.free_rows:
+                row = self.free_rows.pop()
+            else:
+                if self.size == self.matrix.shape[0]:
+                    self.matrix = np.concatenate([self.matrix, np.zeros_like(self.matrix)])
+                    self.paths = np.concatenate([self.paths, np.full(len(self.paths), None, dtype=object)])
+                row = self.size
+                self.size += 1
+            self.rows[file_path] = row
+            self.paths[row] = file_path
+        self.matrix[row] = vector
+
+    def remove(self, file_path):
+        row = self.rows.pop(file_path, None)
+        if row is not None:
+            self.matrix[row] = 0
+            self.paths[row] = None
+            self.free_rows.append(row)
+
+    def rename(self, old_file_path, new_file_path):
+        row = self.rows.pop(old_file_path, None)
+        if row is not None:
+            self.remove(new_file_path)
+            self.rows[new_file_path] = row
+            self.paths[row] = new_file_path
+
+    def get_missing(self, file_paths: set):
+        # The file_paths without a vector
+        return file_paths.difference(self.rows)
+
+    def search(self, vector, file_paths: set, top_k):
+        # Returns the top_k (file_path, score) among file_paths, best first.
+        # All the rows are scored, the best ones are then kept if they belong to file_paths.
+        if not file_paths or self.matrix is None or not self.size:
+            return []
+        vector = np.asarray(vector, dtype=np.float32)
+        scores = self.matrix[:self.size] @ (vector / (np.linalg.norm(vector) or 1))
+        count = min(top_k * 4, self.size)
+        best = np.argpartition(-scores, count - 1)[:count]
+        results = self.pick(best[np.argsort(-scores[best])], scores, file_paths, top_k)
+        if len(results) < top_k and count < self.size:
+            # file_paths are a small part of the index, every row is ranked
+            results = self.pick(np.argsort(-scores), scores, file_paths, top_k)
+        return results
+
+    def pick(self, rows, scores, file_paths: set, top_k):
+        results = []
+        for file_path, score in zip(self.paths[rows].tolist(), scores[rows].tolist()):
+            if file_path in file_paths:
+                results.append((file_path, score))
+                if len(results) == top_k:
+                    break
+        return results
+
+    def get_vectors(self, file_paths):
+        # Matrix of the normalized vectors of file_paths, None if one of them is not indexed
+        if self.matrix is None or any(file_path not in self.rows for file_path in file_paths):
+            return None
+        return self.matrix[[self.rows[file_path] for file_path in file_paths]]
@@ -0,0 +1,67 @@
+"""
+SQLite storage benchmark, run from the backend folder:
+
+    python -m benchmarks.db_benchmark --rows 100000
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from app.database import SQLiteDB
+
+
+def make_rows(count, prefix="/bench"):
+    return [(f"{prefix}/dir_{i // 1000}/file_{i}.txt", f"{i:064x}", f"Summary of file number {i}", i, i * 1000, i,
+             "bench/v1")
+            for i in range(count)]
+
+
+def timed(name, func, count):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f"{name:<40} {elapsed:8.3f}s {count / elapsed:12.0f} rows/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = SQLiteDB(os.path.join(tmp_dir, "bench.db"))
+        rows = make_rows(args.rows)
+        paths = [row[0] for row in rows]
+
+        def buffered_inserts():
+            for row in rows:
+                db.insert_file_summary(row[0], row[1], row[2], row[3:6], row[6])
+            db.flush()
+
+        timed("buffered insert_file_summary", buffered_inserts, args.rows)
+        timed("bulk insert_file_summaries (upsert)", lambda: db.insert_file_summaries(rows), args.rows)
+        timed("batched get_files_stat", lambda: db.get_files_stat(paths), args.rows)
+
+        def concurrent_inserts():
+            chunk = args.rows // args.threads
+
+            def insert(thread_rows):
+                for row in thread_rows:
+                    db.insert_file_summary(row[0], row[1], row[2], row[3:6], row[6])
+                db.flush()
+            threads = [threading.Thread(target=insert, args=(make_rows(chunk, f"/thread_{i}"),))
+                       for i in range(args.threads)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        timed(f"insert_file_summary from {args.threads} threads", concurrent_inserts, args.rows)
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
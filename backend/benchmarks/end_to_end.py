@@ -0,0 +1,280 @@
+"""
+End to end benchmark against the local stub server, run from the backend folder:
+
+    python -m benchmarks.end_to_end --files 1000 --latency 50 --rate-limit-rate 0.02 --output results/base.json
+    python -m benchmarks.end_to_end --files 1000 --latency 50 --rate-limit-rate 0.02 --compare results/base.json
+
+Generates a synthetic tree of text, PDF, docx and image files, starts benchmarks.stub_server in a subprocess and runs
+get_dir_summaries (cold then cached), create_file_tree, search_files_api and /update_files on it. Reports the
+throughput of each stage, p50/p95/p99 latency of the API calls, peak RSS and database size. With --compare, exits
+with an error if a stage is more than --tolerance percent slower than in the saved results.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import zipfile
+import zlib
+
+WORDS = ("invoice", "report", "meeting", "budget", "contract", "recipe", "travel", "research", "project", "photo",
+         "music", "lecture", "resume", "receipt", "schedule", "design", "manual", "letter", "notes", "backup")
+EXTS = {"text": ".txt", "pdf": ".pdf", "docx": ".docx", "image": ".png"}
+
+
+def text_content(i, size):
+    words = [WORDS[(i * 7 + j) % len(WORDS)] for j in range(4)]
+    line = f"{' '.join(words)} number {i}. "
+    return (line * (size // len(line) + 1))[:size]
+
+
+def make_pdf(text):
+    # Single page PDF with the text in one stream, with a valid xref table
+    stream = f"BT /F1 12 Tf 72 720 Td ({text[:2000]}) Tj ET".encode()
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>",
+               b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+               b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R "
+               b"/Resources << /Font << /F1 5 0 R >> >> >>",
+               b"<< /Length " + str(len(stream)).encode() + b" >>\nstream\n" + stream + b"\nendstream",
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += f"{number} 0 obj\n".encode() + obj + b"\nendobj\n"
+    xref = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    pdf += b"".join(f"{offset:010d} 00000 n \n".encode() for offset in offsets)
+    pdf += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return pdf
+
+
+def write_docx(path, text):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as docx:
+        docx.writestr("[Content_Types].xml", (
+            '<?xml version="1.0" encoding="UTF-8"?><Types xmlns="http://schemas.openxmlformats.org/package/2006/'
+            'content-types"><Default Extension="rels" ContentType="application/vnd.openxmlformats-package.'
+            'relationships+xml"/><Default Extension="xml" ContentType="application/xml"/><Override PartName="/word/'
+            'document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.'
+            'main+xml"/></Types>'))
+        docx.writestr("_rels/.rels", (
+            '<?xml version="1.0" encoding="UTF-8"?><Relationships xmlns="http://schemas.openxmlformats.org/package/'
+            '2006/relationships"><Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/'
+            '2006/relationships/officeDocument" Target="word/document.xml"/></Relationships>'))
+        docx.writestr("word/document.xml", (
+            '<?xml version="1.0" encoding="UTF-8"?><w:document xmlns:w="http://schemas.openxmlformats.org/'
+            f'wordprocessingml/2006/main"><w:body><w:p><w:r><w:t>{text}</w:t></w:r></w:p></w:body></w:document>'))
+
+
+def make_png(i, size=64):
+    # Gradient image, different for each file
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+    rows = b"".join(b"\x00" + bytes((x * 4 + i) % 256 for x in range(size)) * 3 for _ in range(size))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b""))
+
+
+def make_tree(root, count, mix, size, files_per_dir=200):
+    kinds = [kind for kind, share in mix.items() for _ in range(round(share * 100))]
+    for i in range(count):
+        kind = kinds[i % len(kinds)]
+        directory = os.path.join(root, f"dir_{i // files_per_dir // 50}", f"sub_{i // files_per_dir}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"file_{i}{EXTS[kind]}")
+        if kind == "text":
+            with open(path, "w") as f:
+                f.write(text_content(i, size))
+        elif kind == "pdf":
+            with open(path, "wb") as f:
+                f.write(make_pdf(text_content(i, size)))
+        elif kind == "docx":
+            write_docx(path, text_content(i, size))
+        else:
+            with open(path, "wb") as f:
+                f.write(make_png(i))
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {f"p{q}": round(values[min(len(values) - 1, int(len(values) * q / 100))] * 1000, 2) for q in (50, 95, 99)}
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_stub(args, port):
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen([sys.executable, "-m", "benchmarks.stub_server", "--port", str(port),
+                                "--latency", str(args.latency), "--jitter", str(args.jitter),
+                                "--error-rate", str(args.error_rate), "--rate-limit-rate", str(args.rate_limit_rate),
+                                "--retry-after", str(args.retry_after)], cwd=backend_dir)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1)
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    sys.exit("stub server didn't start")
+
+
+def timed_api(latencies, kind, func):
+    # Records the duration of each call of an API method
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            latencies.setdefault(kind, []).append(time.perf_counter() - start)
+    return wrapper
+
+
+async def run_stages(args, root):
+    import httpx
+    from app import run, server
+
+    latencies = {}
+    for name in ("summarize_document_api", "summarize_documents_api", "summarize_image_api",
+                 "create_folders_api", "create_file_tree_api_chunk", "search_files_api_chunk", "embed_api"):
+        setattr(run.model, name, timed_api(latencies, name, getattr(run.model, name)))
+
+    stages = {}
+
+    async def stage(name, items, coroutine):
+        start = time.perf_counter()
+        result = await coroutine
+        seconds = time.perf_counter() - start
+        stages[name] = {"seconds": round(seconds, 3), "items": items(result),
+                        "throughput": round(items(result) / seconds, 1) if seconds else None}
+        print(f"{name:<24} {seconds:8.2f}s {stages[name]['items']:>8} items {stages[name]['throughput']:>10}/s")
+        return result
+
+    exts = list(EXTS.values())
+    summaries = await stage("summaries_cold", len, run.get_dir_summaries(root, True, exts))
+    await stage("summaries_cached", len, run.get_dir_summaries(root, True, exts))
+    tree = await stage("file_tree", len, run.create_file_tree(root, summaries))
+    await stage("search", lambda _: len(summaries), run.model.search_files_api(summaries, f"{WORDS[0]} {WORDS[3]}"))
+    if run.model.EMBEDDING_MODEL_NAME:
+        await stage("search_embeddings", lambda _: len(summaries),
+                    run.search_files(root, True, exts, f"{WORDS[0]} {WORDS[3]}"))
+
+    async def update_files():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://bench",
+                                     timeout=None) as client:
+            response = await client.post("/update_files", json={"root_path": root, "items": tree})
+            response.raise_for_status()
+    await stage("update_files", lambda _: len(tree), update_files())
+    await asyncio.to_thread(run.db.flush)
+    return stages, {kind: {"count": len(values), **percentiles(values)} for kind, values in latencies.items()}
+
+
+def compare(results, baseline, tolerance):
+    # Throughput drops above tolerance percent are regressions
+    regressions = []
+    for name, stage in results["stages"].items():
+        before = baseline.get("stages", {}).get(name, {}).get("throughput")
+        if not before or not stage["throughput"]:
+            continue
+        change = (stage["throughput"] - before) / before * 100
+        print(f"{name:<24} {before:>10} -> {stage['throughput']:>10}/s ({change:+.1f}%)")
+        if change < -tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--mix", default="text=0.7,pdf=0.1,docx=0.1,image=0.1",
+                        help="share of each kind of file among text, pdf, docx and image")
+    parser.add_argument("--size", type=int, default=4096, help="size of the text of each file in bytes")
+    parser.add_argument("--latency", type=float, default=50, help="stub response time in ms")
+    parser.add_argument("--jitter", type=float, default=10, help="stub response time variation in ms")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of stub requests failing with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0, help="share of stub requests failing with a 429")
+    parser.add_argument("--retry-after", type=float, default=1)
+    parser.add_argument("--concurrency", type=int, default=8, help="MAX_CONCURRENT_REQUESTS")
+    parser.add_argument("--embeddings", action="store_true", help="also embed summaries and search them locally")
+    parser.add_argument("--output", help="save the results to this json file")
+    parser.add_argument("--compare", help="results json file to compare with")
+    parser.add_argument("--tolerance", type=float, default=20, help="allowed throughput drop in percent")
+    args = parser.parse_args()
+    mix = {kind: float(share) for kind, share in (item.split("=") for item in args.mix.split(","))}
+
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = os.path.join(tmp_dir, "files")
+        start = time.perf_counter()
+        make_tree(root, args.files, mix, args.size)
+        print(f"generated {args.files} files in {time.perf_counter() - start:.1f}s")
+
+        port = free_port()
+        stub = start_stub(args, port)
+        # The settings only come from here, the .env file of the backend folder is not read
+        endpoint = f"http://127.0.0.1:{port}/v1"
+        os.environ.update({"TEXT_API_END_POINT": endpoint, "TEXT_MODEL_NAME": "stub", "TEXT_API_KEYS": '["stub"]',
+                           "IMAGE_API_END_POINT": endpoint, "IMAGE_MODEL_NAME": "stub", "IMAGE_API_KEYS": '["stub"]',
+                           "EMBEDDING_MODEL_NAME": "stub-embedding" if args.embeddings else "",
+                           "MAX_CONCURRENT_REQUESTS": str(args.concurrency),
+                           "DB_PATH": os.path.join(tmp_dir, "bench.db")})
+        sys.path.insert(0, backend_dir)
+        os.chdir(tmp_dir)
+        try:
+            stages, latencies = asyncio.run(run_stages(args, root))
+            stub_stats = json.load(urllib.request.urlopen(f"http://127.0.0.1:{port}/stats"))
+        finally:
+            stub.terminate()
+            stub.wait()
+        db_size = sum(os.path.getsize(os.path.join(tmp_dir, name)) for name in os.listdir(tmp_dir)
+                      if name.startswith("bench.db"))
+        os.chdir(cwd)
+
+    results = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "stages": stages,
+        "latency_ms": latencies,
+        "peak_rss_mb": peak_rss_mb(),
+        "db_size_mb": round(db_size / 1024 / 1024, 2),
+        "stub": stub_stats,
+    }
+    for kind, values in latencies.items():
+        print(f"{kind:<28} {values}")
+    print(f"peak RSS {results['peak_rss_mb']}MB, database {results['db_size_mb']}MB, stub {stub_stats}")
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"slower than {args.compare}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
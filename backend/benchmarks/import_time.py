@@ -0,0 +1,62 @@
+"""
+Cold start budget of the backend, run from the backend folder:
+
+    python -m benchmarks.import_time --budget 1000
+
+Imports app.server in a fresh interpreter with -X importtime, from an empty folder so that no .env file is read.
+Exits with an error if the import takes more than --budget ms, or if it pulls a module that must only be loaded
+on first use (llama index and its readers, openai, numpy, tiktoken).
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+LAZY_MODULES = ("llama_index", "openai", "numpy", "tiktoken", "whisper", "pydub")
+
+
+def import_app(backend_dir):
+    # Returns {module: cumulative import time in us} for a cold import of app.server
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        code = f"import sys; sys.path.insert(0, {backend_dir!r}); import app.server"
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=tmp_dir, capture_output=True,
+                                text=True, env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"})
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, module = line[len("import time:"):].split("|")
+            if cumulative.strip().isdigit():
+                times[module.strip()] = int(cumulative)
+    if result.returncode != 0 or "app.server" not in times:
+        print(result.stderr[-2000:])
+        sys.exit("importing app.server failed")
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget", type=float, default=1000, help="allowed import time of app.server in ms")
+    parser.add_argument("--runs", type=int, default=3, help="the fastest run is kept")
+    args = parser.parse_args()
+
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runs = [import_app(backend_dir) for _ in range(args.runs)]
+    times = min(runs, key=lambda run: run["app.server"])
+    for module in ("app.server", "fastapi", "app.run", "app.settings", "app.database"):
+        if module in times:
+            print(f"{module:<20} {times[module] / 1000:8.1f}ms")
+
+    errors = []
+    eager_modules = sorted({module.split(".")[0] for module in times} & set(LAZY_MODULES))
+    if eager_modules:
+        errors.append(f"imported at startup: {', '.join(eager_modules)}")
+    if times["app.server"] / 1000 > args.budget:
+        errors.append(f"import time above {args.budget}ms")
+    if errors:
+        print("\n".join(errors))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Event loop responsiveness during a directory scan, run from the backend folder:
+
+    python -m benchmarks.loop_latency --files 2000
+
+LLM calls are replaced by a fixed delay so that only the local work (walking, parsing, hashing,
+sqlite) is measured. Exits with an error if a lightweight request waited more than --max-lag ms.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+
+def make_tree(root, count, size):
+    for i in range(count):
+        directory = os.path.join(root, f"dir_{i // 100}")
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"file_{i}.txt"), "w") as f:
+            f.write(f"file {i} " * (size // 8))
+
+
+async def measure_lag(stop, lags, interval=0.01):
+    # A lightweight request is served every interval, record how late it was
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append((time.perf_counter() - start - interval) * 1000)
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.environ["DB_PATH"] = os.path.join(tmp_dir, "bench.db")
+        from app import run
+
+        async def summarize_document_api(doc_text):
+            await asyncio.sleep(args.llm_latency / 1000)
+            return doc_text[:100]
+        run.model.summarize_document_api = summarize_document_api
+
+        # Readers import their dependencies on first use, that one time cost is not measured
+        warm_up = os.path.join(tmp_dir, "warm_up")
+        make_tree(warm_up, 1, args.size)
+        await run.get_dir_summaries(warm_up, True, [".txt"])
+
+        root = os.path.join(tmp_dir, "files")
+        make_tree(root, args.files, args.size)
+        stop = asyncio.Event()
+        lags = []
+        lag_task = asyncio.create_task(measure_lag(stop, lags))
+        start = time.perf_counter()
+        summaries = await run.get_dir_summaries(root, True, [".txt"])
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await lag_task
+
+    lags.sort()
+    print(f"scanned {len(summaries)} files in {elapsed:.2f}s")
+    print(f"event loop lag: p50 {statistics.median(lags):.1f}ms, p99 {lags[int(len(lags) * 0.99)]:.1f}ms, "
+          f"max {lags[-1]:.1f}ms")
+    if lags[-1] > args.max_lag:
+        print(f"max lag above {args.max_lag}ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--size", type=int, default=64 * 1024, help="size of each file in bytes")
+    parser.add_argument("--llm-latency", type=float, default=50, help="simulated LLM latency in ms")
+    parser.add_argument("--max-lag", type=float, default=100, help="allowed event loop lag in ms")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,157 @@
+"""
+Local OpenAI compatible server answering like the models FileWizardAI expects, to benchmark without a live LLM:
+
+    python -m benchmarks.stub_server --port 8765 --latency 50 --error-rate 0.01 --rate-limit-rate 0.02
+
+Point TEXT_API_END_POINT / IMAGE_API_END_POINT to http://127.0.0.1:8765/v1. Summaries are derived from the file
+contents, file tree and search answers from the listed files, embeddings are deterministic vectors of the text.
+GET /stats returns the number of requests, errors and 429 responses per endpoint.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+app = FastAPI()
+config = argparse.Namespace(latency=50, jitter=0, error_rate=0, rate_limit_rate=0, retry_after=1, dim=64, seed=0)
+stats = {}
+rng = random.Random(0)
+
+
+def count(endpoint, outcome):
+    stats.setdefault(endpoint, {"requests": 0, "errors": 0, "rate_limited": 0})[outcome] += 1
+
+
+async def simulate(endpoint):
+    # Returns an error response to send instead of the answer, if any
+    count(endpoint, "requests")
+    if rng.random() < config.rate_limit_rate:
+        count(endpoint, "rate_limited")
+        return JSONResponse({"error": {"message": "Rate limit reached", "type": "rate_limit_exceeded"}},
+                            status_code=429, headers={"retry-after": str(config.retry_after)})
+    await asyncio.sleep(max(0, config.latency + rng.uniform(-config.jitter, config.jitter)) / 1000)
+    if rng.random() < config.error_rate:
+        count(endpoint, "errors")
+        return JSONResponse({"error": {"message": "Internal error", "type": "server_error"}}, status_code=500)
+    return None
+
+
+def message_text(message):
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if part.get("type") == "text")
+    return content
+
+
+def category(summary):
+    # Files are grouped by the first word of their content, "document about <word> ..."
+    words = (summary or "").split()
+    return words[2].lower() if len(words) > 2 else "other"
+
+
+def summarize(text):
+    return "document about " + " ".join(re.findall(r"\w+", text)[:30])
+
+
+def answer(messages):
+    system = message_text(messages[0]) if messages[0].get("role") == "system" else ""
+    user = message_text(messages[-1])
+    if "propose a new path" in system:
+        files = json.loads(user)
+        return json.dumps({"files": [{"src_path": file["file_path"],
+                                      "dst_path": f"{category(file['summary'])}/{file['file_path'].replace('/', '_')}"}
+                                     for file in files]})
+    if "top level folders" in system:
+        groups = json.loads(user)
+        names = sorted({category(example["summary"]) for group in groups for example in group["examples"]})
+        return json.dumps({"folders": [{"path": name, "description": f"documents about {name}"} for name in names]})
+    if "search query:" in system:
+        query = set(re.findall(r"\w+", system.split("search query:")[1].split("\n")[0].lower()))
+        files = json.loads(user)
+        return json.dumps({"files": [{"file": file["file_path"]} for file in files
+                                     if query & set(re.findall(r"\w+", (file["summary"] or "").lower()))]})
+    if "summary of the contents of each file" in system:
+        files = json.loads(user)
+        return json.dumps({"files": [{"id": file["id"], "summary": summarize(file["content"])} for file in files]})
+    if any(part.get("type") == "image_url" for part in messages[-1].get("content") or [] if isinstance(part, dict)):
+        return "image of a synthetic benchmark picture"
+    return summarize(user)
+
+
+def chat_completion(model, content):
+    return {
+        "id": f"chatcmpl-{time.time_ns()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }
+
+
+def embedding(text):
+    # Same text, same vector
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+    vector_rng = random.Random(seed)
+    return [vector_rng.uniform(-1, 1) for _ in range(config.dim)]
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    data = await request.json()
+    error = await simulate("chat")
+    if error is not None:
+        return error
+    return chat_completion(data.get("model", "stub"), answer(data["messages"]))
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    data = await request.json()
+    error = await simulate("embeddings")
+    if error is not None:
+        return error
+    texts = data["input"] if isinstance(data["input"], list) else [data["input"]]
+    return {
+        "object": "list",
+        "model": data.get("model", "stub"),
+        "data": [{"object": "embedding", "index": i, "embedding": embedding(text)} for i, text in enumerate(texts)],
+        "usage": {"prompt_tokens": 0, "total_tokens": 0},
+    }
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=50, help="response time in ms")
+    parser.add_argument("--jitter", type=float, default=0, help="random variation of the response time in ms")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of requests answered with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0, help="share of requests answered with a 429")
+    parser.add_argument("--retry-after", type=float, default=1, help="Retry-After header of the 429 responses")
+    parser.add_argument("--dim", type=int, default=64, help="dimension of the embeddings")
+    parser.add_argument("--seed", type=int, default=0)
+    vars(config).update(vars(parser.parse_args()))
+    rng.seed(config.seed)
+    uvicorn.run(app, host="127.0.0.1", port=config.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()